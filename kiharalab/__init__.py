@@ -25,10 +25,13 @@
 # *
 # **************************************************************************
 import os
+from functools import lru_cache
 
 import pwem
-from scipion.install.funcs import InstallHelper
-from .constants import *
+from .constants import (KIHARALAB_VERSION, DAQ_HOME, EMAP2SEC_HOME, MAINMAST_HOME, CRYOREAD_HOME, DMM_HOME,
+    DAQ_DEFAULT_VERSION, EMAP2SEC_DEFAULT_VERSION, MAINMAST_DEFAULT_VERSION, CRYOREAD_DEFAULT_VERSION, DMM_DEFAULT_VERSION,
+    EMAP2SEC_EXTRA_FILES, EMAP2SECPLUS_EXTRA_FILES, KIHARALAB_PARALLEL_INSTALL, KIHARALAB_CONDA_ENV_CACHE, KIHARALAB_GIT_CACHE,
+    KIHARALAB_PARALLEL_DOWNLOADS, KIHARALAB_DOWNLOAD_SEGMENTS, KIHARALAB_INSTALL_LOGS, KIHARALAB_NATIVE_BUILD)
 
 __version__ = KIHARALAB_VERSION
 _logo = "kiharalab_logo.png"
@@ -44,31 +47,61 @@ class Plugin(pwem.Plugin):
     _<binaryNameInLowercase>Binary will be a folder inside _<packageNameInLowercase>Home and its name will be <binaryName>.
         For example: _emap2secplusBinary = "~/Documents/scipion/software/em/emap2sec-1.0/Emap2secPlus"
     """
+    # Scipion's EM software root, read once for all package homes
+    _emRoot = pwem.Config.EM_ROOT
+
     # DAQ
     daqDefaultVersion = DAQ_DEFAULT_VERSION
-    _daqHome = os.path.join(pwem.Config.EM_ROOT, f'daq-{daqDefaultVersion}')
+    _daqHome = os.path.join(_emRoot, f'daq-{daqDefaultVersion}')
     _daqBinary = os.path.join(_daqHome, 'daq')
+    _daqEnvName = f'daq-{daqDefaultVersion}'
+    _daqPredictResult = os.path.join(_daqBinary, 'Predict_Result')
 
     # Emap2sec
     emap2secDefaultVersion = EMAP2SEC_DEFAULT_VERSION
-    _emap2secHome = os.path.join(pwem.Config.EM_ROOT, f'emap2sec-{emap2secDefaultVersion}')
+    _emap2secHome = os.path.join(_emRoot, f'emap2sec-{emap2secDefaultVersion}')
     _emap2secBinary = os.path.join(_emap2secHome, 'Emap2sec')
     _emap2secplusBinary = os.path.join(_emap2secHome, 'Emap2secPlus')
+    _emap2secEnvName = f'emap2sec-{emap2secDefaultVersion}'
+    _emap2secplusEnvName = f'emap2secPlus-{emap2secDefaultVersion}'
 
     # MainMast
     mainmastDefaultVersion = MAINMAST_DEFAULT_VERSION
-    _mainmastHome = os.path.join(pwem.Config.EM_ROOT, f'mainMast-{mainmastDefaultVersion}')
+    _mainmastHome = os.path.join(_emRoot, f'mainMast-{mainmastDefaultVersion}')
     _mainmastBinary = os.path.join(_mainmastHome, 'MainMast')
+    _mainmastEnvName = f'mainMast-{mainmastDefaultVersion}'
 
     # DMM
     dmmDefaultVersion = DMM_DEFAULT_VERSION
-    _DMMHome = os.path.join(pwem.Config.EM_ROOT, f'dmm-{dmmDefaultVersion}')
+    _DMMHome = os.path.join(_emRoot, f'dmm-{dmmDefaultVersion}')
     _DMMBinary = os.path.join(_DMMHome, 'DMM')
+    _DMMEnvName = f'dmm-{dmmDefaultVersion}'
 
     # CryoREAD
     cryoREADDefaultVersion = CRYOREAD_DEFAULT_VERSION
-    _cryoREADHome = os.path.join(pwem.Config.EM_ROOT, f'cryoREAD-{cryoREADDefaultVersion}')
+    _cryoREADHome = os.path.join(_emRoot, f'cryoREAD-{cryoREADDefaultVersion}')
     _cryoREADBinary = os.path.join(_cryoREADHome, 'CryoREAD')
+    _cryoREADPredictResult = os.path.join(_cryoREADBinary, 'Predict_Result')
+    _cryoREADEnvName = f'cryoREAD-{cryoREADDefaultVersion}'
+
+    # Conda environment names by repository name
+    _envNames = {
+        'daq': _daqEnvName,
+        'emap2sec': _emap2secEnvName,
+        'emap2secPlus': _emap2secplusEnvName,
+        'mainMast': _mainmastEnvName,
+        'dmm': _DMMEnvName,
+        'cryoREAD': _cryoREADEnvName
+    }
+
+    # Install dependencies shared by all packages cloned from git into a conda environment
+    _condaPackageDependencies = ['git', 'conda']
+
+    # Build command using all available cores (falls back to 2 jobs if the core count can't be read)
+    _makeCommand = "make -j$(getconf _NPROCESSORS_ONLN 2>/dev/null || echo 2)"
+
+    # Grants execution permission only to scripts, instead of every file in the repository. Compiled binaries are already executable
+    _grantExecPermissionCommand = r"find . -path ./.git -prune -o -type f \( -name '*.sh' -o -name '*.pl' -o -name '*.py' \) -exec chmod +x {} +"
 
     @classmethod
     def _defineVariables(cls):
@@ -80,24 +113,33 @@ class Plugin(pwem.Plugin):
         """
         # DAQ
         cls._defineEmVar(DAQ_HOME, cls._daqHome)
-        cls._defineVar('DAQ_ENV', f'daq-{cls.daqDefaultVersion}')
+        cls._defineVar('DAQ_ENV', cls._daqEnvName)
 
         # Emap2sec
         cls._defineEmVar(EMAP2SEC_HOME, cls._emap2secHome)
-        cls._defineVar('EMAP2SEC_ENV', f'emap2sec-{cls.emap2secDefaultVersion}')
-        cls._defineVar('EMAP2SECPLUS_ENV', f'emap2secPlus-{cls.emap2secDefaultVersion}')
+        cls._defineVar('EMAP2SEC_ENV', cls._emap2secEnvName)
+        cls._defineVar('EMAP2SECPLUS_ENV', cls._emap2secplusEnvName)
 
         # MainMast
         cls._defineEmVar(MAINMAST_HOME, cls._mainmastHome)
-        cls._defineVar('MAINMAST_ENV', f'mainMast-{cls.mainmastDefaultVersion}')
+        cls._defineVar('MAINMAST_ENV', cls._mainmastEnvName)
 
         # DMM
         cls._defineEmVar(DMM_HOME, cls._DMMHome)
-        cls._defineVar('DMM_ENV', f'dmm-{cls.dmmDefaultVersion}')
+        cls._defineVar('DMM_ENV', cls._DMMEnvName)
 
         # CryoREAD
         cls._defineEmVar(CRYOREAD_HOME, cls._cryoREADHome)
-        cls._defineVar('CRYOREAD_ENV', f'cryoREAD-{cls.cryoREADDefaultVersion}')
+        cls._defineVar('CRYOREAD_ENV', cls._cryoREADEnvName)
+
+        # Installation options
+        cls._defineVar(KIHARALAB_PARALLEL_INSTALL, '0')
+        cls._defineVar(KIHARALAB_CONDA_ENV_CACHE, '')
+        cls._defineVar(KIHARALAB_GIT_CACHE, '')
+        cls._defineVar(KIHARALAB_PARALLEL_DOWNLOADS, '8')
+        cls._defineVar(KIHARALAB_DOWNLOAD_SEGMENTS, '1')
+        cls._defineVar(KIHARALAB_INSTALL_LOGS, '0')
+        cls._defineVar(KIHARALAB_NATIVE_BUILD, '0')
 
     @classmethod
     def defineBinaries(cls, env):
@@ -119,12 +161,12 @@ class Plugin(pwem.Plugin):
         packageName = 'daq'
 
         # Instanciating installer
-        installer = InstallHelper(packageName, packageVersion=cls.daqDefaultVersion)
+        installer = cls._getInstaller(packageName, cls.daqDefaultVersion)
 
         # Installing protocol
         installer.getCloneCommand('https://github.com/kiharalab/DAQ.git', binaryFolderName=packageName)\
             .getCondaEnvCommand(pythonVersion='3.9', binaryPath=cls._daqBinary, requirementsFile=True)\
-            .addPackage(env, dependencies=['git', 'conda'])
+            .addPackage(env, dependencies=cls._condaPackageDependencies)
 
     @classmethod    
     def addEmap2sec(cls, env):
@@ -137,54 +179,46 @@ class Plugin(pwem.Plugin):
         emap2secPlusFolderName = 'Emap2secPlus'
 
         # Instanciating installer
-        installer = InstallHelper(packageName, packageVersion=cls.emap2secDefaultVersion)
+        installer = cls._getInstaller(packageName, cls.emap2secDefaultVersion)
 
         # Defining extra files to download
-        firstLocation = "models/emap2sec_models_exp1"
-        secondLocation = "models/emap2sec_models_exp2"
-        emap2secExtraFiles = [
-            installer.getFileDict("https://kiharalab.org/Emap2sec_models/emap2sec_models_exp1/checkpoint", path=firstLocation),
-            installer.getFileDict("https://kiharalab.org/Emap2sec_models/emap2sec_models_exp1/emap2sec_L1_exp.ckpt-108000.data-00000-of-00001", path=firstLocation),
-            installer.getFileDict("https://kiharalab.org/Emap2sec_models/emap2sec_models_exp1/emap2sec_L1_exp.ckpt-108000.index", path=firstLocation),
-            installer.getFileDict("https://kiharalab.org/Emap2sec_models/emap2sec_models_exp1/emap2sec_L1_exp.ckpt-108000.meta", path=firstLocation),
-            installer.getFileDict("https://kiharalab.org/Emap2sec_models/emap2sec_models_exp2/checkpoint", path=secondLocation),
-            installer.getFileDict("https://kiharalab.org/Emap2sec_models/emap2sec_models_exp2/emap2sec_L2_exp.ckpt-20000.data-00000-of-00001", path=secondLocation),
-            installer.getFileDict("https://kiharalab.org/Emap2sec_models/emap2sec_models_exp2/emap2sec_L2_exp.ckpt-20000.index", path=secondLocation),
-            installer.getFileDict("https://kiharalab.org/Emap2sec_models/emap2sec_models_exp2/emap2sec_L2_exp.ckpt-20000.meta", path=secondLocation)
-        ]
-
-        emap2secPlusExtraFiles = [
-            installer.getFileDict("https://kiharalab.org/emsuites/emap2secplus_model/best_model.tar.gz"),
-            installer.getFileDict("https://kiharalab.org/emsuites/emap2secplus_model/nocontour_best_model.tar.gz")
-        ]
+        emap2secExtraFiles = [installer.getFileDict(url, path=path) for url, path in EMAP2SEC_EXTRA_FILES]
+        emap2secPlusExtraFiles = [installer.getFileDict(url, path=path) for url, path in EMAP2SECPLUS_EXTRA_FILES]
 
         # Defininig extra commands to run
-        grantExecPermission = "chmod -R +x *"
+        # Build steps can be safely run again, so each binary's steps are grouped in a single command
+        grantExecPermission = cls._grantExecPermissionCommand
         emap2secExtraCommands = [
-            "mkdir -p results",
-            grantExecPermission,
-            "cd map2train_src && make",
-            grantExecPermission
+            f"mkdir -p results && {grantExecPermission} && cd map2train_src && {cls._makeCommand}"
         ]
 
+        emap2secPlusArchives = ["best_model.tar.gz", "nocontour_best_model.tar.gz"]
         emap2secPlusExtraCommands = [
-            "tar -xf best_model.tar.gz && rm -f best_model.tar.gz",
-            "tar -xf nocontour_best_model.tar.gz && rm -f nocontour_best_model.tar.gz",
-            "cd process_map && make",
-            grantExecPermission
+            f"{grantExecPermission} && cd process_map && {cls._makeCommand}"
         ]
 
+        # aria2c download settings, shared by both model batches
+        downloadOptions = {'parallelDownloads': cls.getParallelDownloads(), 'segments': cls.getDownloadSegments()}
+
+        # Both repositories are independent, so they can be cloned at the same time.
+        # Meanwhile, Emap2sec+'s conda packages (the biggest ones) are solved and downloaded
+        repositories = [
+            ('https://github.com/kiharalab/emap2sec.git', emap2secFolderName),
+            ('https://github.com/kiharalab/emap2secPlus.git', emap2secPlusFolderName)
+        ]
+        emap2secPlusEnvSpec = {'pythonVersion': '3.6.9', 'condaPackages': ['pytorch::pytorch==1.1.0', 'cudatoolkit=10.0'], 'channel': 'pytorch'}
+        prefetchCommands = [installer.getCondaPrefetchCmd(binaryName='emap2secPlus', **emap2secPlusEnvSpec)]
+
         # Installing protocol
-        installer.getCloneCommand('https://github.com/kiharalab/emap2sec.git', binaryFolderName=emap2secFolderName)\
-            .getCloneCommand('https://github.com/kiharalab/emap2secPlus.git', binaryFolderName=emap2secPlusFolderName)\
+        installer.getCloneCommands(repositories, packageName, parallel=cls.isParallelInstall(), parallelCommands=prefetchCommands)\
             .getCondaEnvCommand(binaryPath=cls._emap2secBinary, pythonVersion='3.6', requirementsFile=True)\
-            .getCondaEnvCommand(binaryPath=cls._emap2secplusBinary, binaryName='emap2secPlus', pythonVersion='3.6.9', requirementsFile=True)\
-            .addCondaPackages(packages=['pytorch==1.1.0', 'cudatoolkit=10.0'], binaryName='emap2secPlus', channel='pytorch')\
-            .getExtraFiles(emap2secExtraFiles, workDir=cls._emap2secBinary)\
-            .getExtraFiles(emap2secPlusExtraFiles, binaryName='emap2secPlus', workDir=cls._emap2secplusBinary)\
+            .getCondaEnvCommand(binaryPath=cls._emap2secplusBinary, binaryName='emap2secPlus', requirementsFile=True, **emap2secPlusEnvSpec)\
+            .getExtraFilesBatch(emap2secExtraFiles, packageName, workDir=cls._emap2secBinary, **downloadOptions)\
+            .getExtraFilesBatch(emap2secPlusExtraFiles, 'emap2secPlus', workDir=cls._emap2secplusBinary, **downloadOptions)\
+            .extractArchives(emap2secPlusArchives, 'emap2secPlus', workDir=cls._emap2secplusBinary, parallel=cls.isParallelInstall())\
             .addCommands(emap2secExtraCommands, workDir=cls._emap2secBinary)\
             .addCommands(emap2secPlusExtraCommands, binaryName='emap2secPlus', workDir=cls._emap2secplusBinary)\
-            .addPackage(env, dependencies=['git', 'conda', 'wget', 'make', 'gcc', 'tar'])
+            .addPackage(env, dependencies=[*cls._condaPackageDependencies, 'wget', 'make', 'gcc', 'tar'])
 
     @classmethod    
     def addMainMast(cls, env):
@@ -195,18 +229,24 @@ class Plugin(pwem.Plugin):
         packageName = 'mainMast'
 
         # Instanciating installer
-        installer = InstallHelper(packageName, packageVersion=cls.mainmastDefaultVersion)
+        installer = cls._getInstaller(packageName, cls.mainmastDefaultVersion)
+        from .install_helper import GZIP_PROGRAM # Only needed when defining binaries, like the installer
+
+        # MainMast is compute heavy, so it can optionally be optimized for this machine's CPU.
+        # Flags are appended to the Makefile's own CFLAGS, since passing CFLAGS to make would replace them and drop the flags
+        # MainMast needs. They are only appended once, so the build can be run again. The resulting binary may not run on other CPUs
+        makeCommand = cls._makeCommand
+        if cls.getVar(KIHARALAB_NATIVE_BUILD) == '1':
+            nativeFlags = '-O3 -march=native'
+            makeCommand = f"(grep -q -- '{nativeFlags}' Makefile || echo 'CFLAGS += {nativeFlags}' >> Makefile) && {cls._makeCommand}"
 
-        # Extra commands
-        grantExecPermission = "chmod -R +x *"
+        # Extra commands. Build steps can be safely run again, so they are grouped in a single command,
+        # but decompressing the examples can not, so it is kept apart
+        grantExecPermission = cls._grantExecPermissionCommand
         cleanObjs = "rm -rf *.o"
         extraCommands = [
-            cleanObjs + " MainmastSeg",
-            grantExecPermission,
-            "make",
-            cleanObjs,
-            grantExecPermission,
-            "cd example1 && gunzip emd-0093.mrc.gz MAP_m4A.mrc.gz region0.mrc.gz region1.mrc.gz region2.mrc.gz region3.mrc.gz"
+            f"{cleanObjs} MainmastSeg && {grantExecPermission} && {makeCommand} && {cleanObjs}",
+            f"cd example1 && {GZIP_PROGRAM} -d emd-0093.mrc.gz MAP_m4A.mrc.gz region0.mrc.gz region1.mrc.gz region2.mrc.gz region3.mrc.gz"
         ]
 
         # Installing protocol
@@ -223,16 +263,15 @@ class Plugin(pwem.Plugin):
         packageName = 'cryoREAD'
 
         # Instantiating installer
-        installer = InstallHelper(packageName, packageVersion=cls.cryoREADDefaultVersion)
+        installer = cls._getInstaller(packageName, cls.cryoREADDefaultVersion)
 
         # Installing protocol
         currentPath = os.path.dirname(os.path.abspath(__file__))
         enFilePath = os.path.join(currentPath, "environment.yml")
         targetFile = f"{packageName.upper()}_CONDA_ENV_CREATED"
-        envName = f"{packageName}-{cls.cryoREADDefaultVersion}"
         installer.getCloneCommand('https://github.com/kiharalab/CryoREAD.git', binaryFolderName=os.path.basename(cls._cryoREADBinary)) \
-            .addCommand(f"conda env create -y -n {envName} -f {enFilePath}", workDir=cls._cryoREADBinary, targetName=targetFile)\
-            .addPackage(env, dependencies=['git', 'conda'])
+            .addCommand(f"conda env create -y -n {cls._cryoREADEnvName} -f {enFilePath}", workDir=cls._cryoREADBinary, targetName=targetFile)\
+            .addPackage(env, dependencies=cls._condaPackageDependencies)
 
     @classmethod    
     def addDMM(cls, env):
@@ -243,28 +282,97 @@ class Plugin(pwem.Plugin):
         packageName = 'dmm'
 
         # Instanciating installer
-        installer = InstallHelper(packageName, packageVersion=cls.dmmDefaultVersion)
+        installer = cls._getInstaller(packageName, cls.dmmDefaultVersion)
         
         # Installing protocol
         currentPath = os.path.dirname(os.path.abspath(__file__))
         enFilePath = os.path.join(currentPath, "environment.yml")
         targetFile = f"{packageName.upper()}_CONDA_ENV_CREATED"
-        envName = f"{packageName}-{cls.dmmDefaultVersion}"
         installer.getCloneCommand('https://github.com/kiharalab/DeepMainMast.git', binaryFolderName=os.path.basename(cls._DMMBinary))\
-            .addCommand(f"conda env create -y -n {envName} -f {enFilePath}", workDir=cls._DMMBinary, targetName=targetFile)\
-            .addPackage(env, dependencies=['git', 'conda'])
+            .addCommand(f"conda env create -y -n {cls._DMMEnvName} -f {enFilePath}", workDir=cls._DMMBinary, targetName=targetFile)\
+            .addPackage(env, dependencies=cls._condaPackageDependencies)
 
     # ---------------------------------- Utils functions  -----------------------
+    @classmethod
+    def _getInstaller(cls, packageName, packageVersion):
+        """
+        Returns an installer for the given package.
+        The installer module is imported here, as it is only needed when defining binaries,
+        and not when Scipion loads the plugin.
+        """
+        from .install_helper import InstallHelper
+        return InstallHelper(
+            packageName,
+            packageVersion=packageVersion,
+            envCacheDir=cls.getVar(KIHARALAB_CONDA_ENV_CACHE),
+            gitCacheDir=cls.getVar(KIHARALAB_GIT_CACHE),
+            logCommands=cls.getVar(KIHARALAB_INSTALL_LOGS) == '1'
+        )
+
+    @classmethod
+    def isParallelInstall(cls):
+        """
+        Returns True if independent install steps (such as git clones) should run at the same time.
+        Disabled by default, so install logs keep a deterministic order.
+        """
+        return cls.getVar(KIHARALAB_PARALLEL_INSTALL) == '1'
+
+    @classmethod
+    def getParallelDownloads(cls):
+        """
+        Returns the maximum number of files downloaded at the same time when aria2c is available.
+        Invalid values fall back to a single download at a time.
+        """
+        return cls._getPositiveIntVar(KIHARALAB_PARALLEL_DOWNLOADS)
+
+    @classmethod
+    def getDownloadSegments(cls):
+        """
+        Returns the number of connections used to download each large file when aria2c is available.
+        Defaults to a single connection, so downloads behave the same on every machine unless requested otherwise.
+        """
+        return cls._getPositiveIntVar(KIHARALAB_DOWNLOAD_SEGMENTS)
+
+    @classmethod
+    def _getPositiveIntVar(cls, varName):
+        """
+        Returns the value of the given variable as a positive integer, or 1 if it is not a valid one.
+        """
+        try:
+            return max(int(cls.getVar(varName)), 1)
+        except (TypeError, ValueError):
+            return 1
+
     @classmethod
     def getProtocolEnvName(cls, protocolName, repoName=None):
         """
         This function returns the env name for a given protocol and repo.
+        Known repos are looked up in the precomputed env names.
         """
-        return f"{repoName if repoName else protocolName}-{getattr(cls, protocolName + 'DefaultVersion')}"
+        envName = cls._envNames.get(repoName if repoName else protocolName)
+        return envName if envName else f"{repoName if repoName else protocolName}-{getattr(cls, protocolName + 'DefaultVersion')}"
     
     @classmethod
+    @lru_cache(maxsize=None)
     def getProtocolActivationCommand(cls, protocolName, repoName=None):
         """
         Returns the conda activation command for the given protocol.
         """
         return f"conda activate {cls.getProtocolEnvName(protocolName, repoName)}"
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def getProtocolFullActivationCommand(cls, protocolName, repoName=None):
+        """
+        Returns the full command needed to activate the conda environment of the given protocol from a new shell.
+        """
+        return f"{cls.getCondaActivationCmd()} {cls.getProtocolActivationCommand(protocolName, repoName)}"
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def getCondaActivationCmd(cls):
+        """
+        Returns the command that makes conda available in the shell.
+        It is built from Scipion's config, which does not change while running, so it is only computed once.
+        """
+        return super().getCondaActivationCmd()
@@ -34,6 +34,32 @@ MAINMAST_HOME = 'MAINMAST_HOME'
 CRYOREAD_HOME = 'CRYOREAD_HOME'
 DMM_HOME = 'DMM_HOME'
 
+# Installation options
+KIHARALAB_PARALLEL_INSTALL = 'KIHARALAB_PARALLEL_INSTALL'
+KIHARALAB_CONDA_ENV_CACHE = 'KIHARALAB_CONDA_ENV_CACHE'
+KIHARALAB_GIT_CACHE = 'KIHARALAB_GIT_CACHE'
+KIHARALAB_PARALLEL_DOWNLOADS = 'KIHARALAB_PARALLEL_DOWNLOADS'
+KIHARALAB_DOWNLOAD_SEGMENTS = 'KIHARALAB_DOWNLOAD_SEGMENTS'
+KIHARALAB_INSTALL_LOGS = 'KIHARALAB_INSTALL_LOGS'
+KIHARALAB_NATIVE_BUILD = 'KIHARALAB_NATIVE_BUILD'
+
+# Extra files to download, as (url, destination folder) pairs
+EMAP2SEC_MODELS_URL = 'https://kiharalab.org/Emap2sec_models'
+EMAP2SEC_EXTRA_FILES = [
+    (f'{EMAP2SEC_MODELS_URL}/emap2sec_models_exp1/checkpoint', 'models/emap2sec_models_exp1'),
+    (f'{EMAP2SEC_MODELS_URL}/emap2sec_models_exp1/emap2sec_L1_exp.ckpt-108000.data-00000-of-00001', 'models/emap2sec_models_exp1'),
+    (f'{EMAP2SEC_MODELS_URL}/emap2sec_models_exp1/emap2sec_L1_exp.ckpt-108000.index', 'models/emap2sec_models_exp1'),
+    (f'{EMAP2SEC_MODELS_URL}/emap2sec_models_exp1/emap2sec_L1_exp.ckpt-108000.meta', 'models/emap2sec_models_exp1'),
+    (f'{EMAP2SEC_MODELS_URL}/emap2sec_models_exp2/checkpoint', 'models/emap2sec_models_exp2'),
+    (f'{EMAP2SEC_MODELS_URL}/emap2sec_models_exp2/emap2sec_L2_exp.ckpt-20000.data-00000-of-00001', 'models/emap2sec_models_exp2'),
+    (f'{EMAP2SEC_MODELS_URL}/emap2sec_models_exp2/emap2sec_L2_exp.ckpt-20000.index', 'models/emap2sec_models_exp2'),
+    (f'{EMAP2SEC_MODELS_URL}/emap2sec_models_exp2/emap2sec_L2_exp.ckpt-20000.meta', 'models/emap2sec_models_exp2')
+]
+EMAP2SECPLUS_EXTRA_FILES = [
+    ('https://kiharalab.org/emsuites/emap2secplus_model/best_model.tar.gz', '.'),
+    ('https://kiharalab.org/emsuites/emap2secplus_model/nocontour_best_model.tar.gz', '.')
+]
+
 # Supported versions
 V1_0 = '1.0'
 
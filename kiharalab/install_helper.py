@@ -0,0 +1,448 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *           Martín Salinas  (martin.salinas@cnb.csic.es)
+# *
+# * Biocomputing Unit, CNB-CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import hashlib
+import os
+from typing import Dict, List, Tuple
+
+from scipion.install.funcs import InstallHelper as ScipionInstallHelper
+
+from . import Plugin
+
+# Conda-compatible executable used to solve and create environments. mamba is much faster, so it is used if available
+CONDA_SOLVER = "$(command -v mamba >/dev/null 2>&1 && echo mamba || echo conda)"
+
+# Gzip decompressor used when extracting archives. pigz uses all available cores, so it is used if available
+GZIP_PROGRAM = "$(command -v pigz >/dev/null 2>&1 && echo pigz || echo gzip)"
+
+# SHA-256 checksum program. sha256sum is not available by default on macOS, where shasum is used instead
+SHA256_PROGRAM = "$(command -v sha256sum >/dev/null 2>&1 && echo sha256sum || echo 'shasum -a 256')"
+
+class InstallHelper(ScipionInstallHelper):
+    """
+    ### Extension of Scipion's InstallHelper with the install commands needed by this plugin.
+    """
+    def __init__(self, packageName: str, envCacheDir: str='', gitCacheDir: str='', logCommands: bool=False, **kwargs):
+        """
+        ### Constructor for the InstallHelper class.
+
+        #### Params:
+        - packageName (str): Name of the package.
+        - envCacheDir (str): Optional. Directory where conda environments are cached as conda-pack archives. If empty, no cache is used.
+        - gitCacheDir (str): Optional. Directory where mirrors of the cloned repositories are kept. If empty, no cache is used.
+        - logCommands (bool): Optional. If True, the output of each command is also saved in a '<targetName>.log' file.
+        - **kwargs: Any other argument accepted by Scipion's InstallHelper (packageHome, packageVersion).
+        """
+        super().__init__(packageName, **kwargs)
+        self._packageName = packageName
+        self._packageVersion = kwargs.get('packageVersion')
+        self._envCacheDir = envCacheDir
+        self._gitCacheDir = gitCacheDir
+        self._logCommands = logCommands
+
+    def addCommand(self, command: str, targetName: str='', workDir: str=''):
+        """
+        ### This function adds the given command with its target file to the list of install commands.
+        ### Unlike Scipion's version, commands with a working directory are run inside a subshell,
+        ### so there is no need to go back to the previous directory with 'cd -' afterwards.
+        ### If enabled, the command's output is also saved in a log file named after the target.
+
+        #### Params:
+        - command (str): Command to add.
+        - targetName (str): Optional. Name of the target file for this command.
+        - workDir (str): Optional. Directory where the command will be run from.
+
+        #### Returns:
+        - (InstallHelper): Returns itself so it can be chained.
+
+        #### Usage:
+        installer.addCommand('make', targetName='BINARY_COMPILED', workDir='/path/to/binary')
+        """
+        if workDir:
+            command = f"(cd {workDir} && {command})"
+        if self._logCommands and targetName:
+            # Output is still shown while being saved. The exit status is kept in a file, as a pipe would hide it
+            statusFile = f".{targetName}.status"
+            command = f'{{ ( {command} ) 2>&1; echo $? > {statusFile}; }} | tee {targetName}.log && [ "$(cat {statusFile})" = 0 ] && rm -f {statusFile}'
+        return super().addCommand(command, targetName=targetName)
+
+    def addCommands(self, commandList: List[str], binaryName: str=None, workDir: str='', targetNames: List[str]=[]):
+        """
+        ### This function adds the given commands, each one with its own target file, to the list of install commands.
+
+        #### Params:
+        - commandList (list[str]): List of commands to add.
+        - binaryName (str): Optional. Name of the binary. Default is package name. Used to build the default target names.
+        - workDir (str): Optional. Directory where the commands will be run from.
+        - targetNames (list[str]): Optional. List of target file names, one per command.
+
+        #### Returns:
+        - (InstallHelper): Returns itself so it can be chained.
+
+        #### Usage:
+        installer.addCommands(['make', 'chmod +x myBinary'], binaryName='myBinary', workDir='/path/to/binary')
+        """
+        if targetNames and len(targetNames) != len(commandList):
+            raise ValueError(f"Got {len(targetNames)} target names for {len(commandList)} commands.")
+        if not targetNames:
+            targetPrefix = f"{(binaryName if binaryName else self._packageName).upper()}_EXTRA_COMMAND_"
+            targetNames = [f"{targetPrefix}{idx}" for idx in range(len(commandList))]
+        for command, targetName in zip(commandList, targetNames):
+            self.addCommand(command, targetName=targetName, workDir=workDir)
+        return self
+
+    def getCondaEnvCommand(self, binaryName: str=None, binaryPath: str=None, binaryVersion: str=None, pythonVersion: str=None,
+                           requirementsFile: bool=False, requirementFileName: str='requirements.txt', requirementList: List[str]=[],
+                           extraCommands: List[str]=[], condaPackages: List[str]=[], channel: str=None, targetName: str=None):
+        """
+        ### This function creates the conda environment for the given binary and installs its pip requirements.
+        ### Unlike Scipion's version, pip is installed when creating the environment, instead of with a separate
+        ### 'conda install' that needs another dependency solve, and mamba is used to create it if available.
+        ### If an environment cache directory was given, the environment is restored from there when possible.
+
+        #### Params:
+        - binaryName (str): Optional. Name of the binary. Default is package name.
+        - binaryPath (str): Optional. Path to the binary. The requirements and extra commands are run from there.
+        - binaryVersion (str): Optional. Binary's version. Default is package version.
+        - pythonVersion (str): Optional. Python version of the environment.
+        - requirementsFile (bool): Optional. If True, the binary's requirements file is installed with pip.
+        - requirementFileName (str): Optional. Name of the requirements file.
+        - requirementList (list[str]): Optional. List of extra packages to install with pip.
+        - extraCommands (list[str]): Optional. List of extra commands to run within the environment.
+        - condaPackages (list[str]): Optional. List of conda packages to install when creating the environment, within the same dependency solve.
+        - channel (str): Optional. Channel the conda packages are installed from. If given, strict channel priority is used.
+        - targetName (str): Optional. Name of the target file for this command.
+
+        #### Returns:
+        - (InstallHelper): Returns itself so it can be chained.
+
+        #### Usage:
+        installer.getCondaEnvCommand(binaryPath='/path/to/binary', pythonVersion='3.9', requirementsFile=True)
+        """
+        binaryName = binaryName if binaryName else self._packageName
+        binaryVersion = binaryVersion if binaryVersion else self._packageVersion
+        envName = f"{binaryName}-{binaryVersion}"
+
+        commands = [
+            self._getCondaCreateCmd(envName, pythonVersion, condaPackages, channel),
+            f"conda activate {envName}"
+        ]
+
+        # Binary specific commands are run in a subshell so the target file is created from the current directory
+        binaryCommands = []
+        if requirementsFile:
+            binaryCommands.append(f"pip install -r {requirementFileName}")
+        if requirementList:
+            binaryCommands.append(f"pip install {' '.join(requirementList)}")
+        binaryCommands.extend(extraCommands)
+        if binaryCommands:
+            cdCommand = [f"cd {binaryPath}"] if binaryPath else []
+            commands.append(f"({' && '.join(cdCommand + binaryCommands)})")
+
+        envCommand = ' && '.join(commands)
+        # Extra commands may modify more than the environment, so they can not be skipped by restoring it from the cache
+        if self._envCacheDir and not extraCommands:
+            requirementsPath = os.path.join(binaryPath if binaryPath else '.', requirementFileName) if requirementsFile else None
+            envCommand = self._getCachedEnvCommand(envName, envCommand, (pythonVersion, requirementList, condaPackages, channel), requirementsPath)
+
+        targetName = targetName if targetName else f"{binaryName.upper()}_CONDA_ENV_CREATED"
+        return self.addCommand(f"{Plugin.getCondaActivationCmd()} {envCommand}", targetName=targetName)
+
+    def getCondaPrefetchCmd(self, binaryName: str=None, binaryVersion: str=None, pythonVersion: str=None,
+                            condaPackages: List[str]=[], channel: str=None) -> str:
+        """
+        ### This function returns a command that solves the binary's conda environment and downloads its packages
+        ### into conda's package cache, without creating it. Running it while other install steps are running
+        ### (see getCloneCommands) makes the later environment creation much faster. It never fails.
+
+        #### Params:
+        - binaryName (str): Optional. Name of the binary. Default is package name.
+        - binaryVersion (str): Optional. Binary's version. Default is package version.
+        - pythonVersion (str): Optional. Python version of the environment.
+        - condaPackages (list[str]): Optional. List of conda packages of the environment.
+        - channel (str): Optional. Channel the conda packages are installed from.
+
+        #### Returns:
+        - (str): The prefetch command.
+
+        #### Usage:
+        installer.getCondaPrefetchCmd(pythonVersion='3.9', condaPackages=['pytorch'], channel='pytorch')
+        """
+        binaryName = binaryName if binaryName else self._packageName
+        binaryVersion = binaryVersion if binaryVersion else self._packageVersion
+        createCmd = self._getCondaCreateCmd(f"{binaryName}-{binaryVersion}", pythonVersion, condaPackages, channel, downloadOnly=True)
+        return f"({Plugin.getCondaActivationCmd()} {createCmd} >/dev/null 2>&1 || true)"
+
+    @staticmethod
+    def _getCondaCreateCmd(envName: str, pythonVersion: str=None, condaPackages: List[str]=[], channel: str=None, downloadOnly: bool=False) -> str:
+        """
+        ### This function returns the command that creates a conda environment with python, pip and the given conda packages.
+
+        #### Params:
+        - envName (str): Name of the environment.
+        - pythonVersion (str): Optional. Python version of the environment.
+        - condaPackages (list[str]): Optional. List of conda packages to install.
+        - channel (str): Optional. Channel the conda packages are installed from. If given, strict channel priority is used.
+        - downloadOnly (bool): Optional. If True, packages are only downloaded into conda's package cache.
+
+        #### Returns:
+        - (str): The creation command.
+        """
+        pythonPackage = f"python={pythonVersion}" if pythonVersion else "python"
+        channelOptions = f" -c {channel} --strict-channel-priority" if channel else ''
+        downloadOption = " --download-only" if downloadOnly else ''
+        return f"{CONDA_SOLVER} create -y -n {envName} {' '.join([pythonPackage, 'pip', *condaPackages])}{channelOptions}{downloadOption}"
+
+    def _getCachedEnvCommand(self, envName: str, envCommand: str, spec: Tuple, requirementsPath: str=None) -> str:
+        """
+        ### This function wraps the given environment creation command so the environment is restored from a conda-pack
+        ### archive in the cache directory if one exists for the same specification, or stored there once created.
+        ### Environments are only stored if conda-pack is installed, and failing to store them does not stop the installation.
+
+        #### Params:
+        - envName (str): Name of the conda environment.
+        - envCommand (str): Command that creates the environment from scratch.
+        - spec (tuple): Everything defining the contents of the environment, used to build the archive name.
+        - requirementsPath (str): Optional. Path to the requirements file installed in the environment.
+
+        #### Returns:
+        - (str): The wrapped command.
+        """
+        specHash = hashlib.sha256(repr(spec).encode()).hexdigest()[:16]
+        # Requirements file contents are only known once the repository has been cloned, so they are hashed at install time
+        requirementsHash = f"-$({SHA256_PROGRAM} {requirementsPath} | cut -c1-16)" if requirementsPath else ''
+        restoreCmd = 'mkdir -p "$envPrefix" && tar -xzf "$envArchive" -C "$envPrefix" && "$envPrefix/bin/conda-unpack"'
+        storeCmd = (f'(! command -v conda-pack >/dev/null 2>&1 || (mkdir -p {self._envCacheDir} && '
+            f'conda-pack -n {envName} --format tar.gz -o "$envArchive.tmp" && mv "$envArchive.tmp" "$envArchive") || '
+            f'(rm -f "$envArchive.tmp" && echo "Could not store {envName} environment in cache."))')
+        return (f'envArchive="{self._envCacheDir}/{envName}-{specHash}{requirementsHash}.tar.gz" && '
+            f'envPrefix="$(conda info --base)/envs/{envName}" && '
+            f'if [ -f "$envArchive" ]; then {restoreCmd}; else {envCommand} && {storeCmd}; fi')
+
+    def getFileDict(self, url: str, path: str='.', fileName: str=None, sha256: str=None) -> Dict[str, str]:
+        """
+        ### This function returns the dictionary of a file to download, as expected by getExtraFilesBatch.
+
+        #### Params:
+        - url (str): Url of the file to download.
+        - path (str): Optional. Folder where the file will be downloaded, relative to the download's workDir.
+        - fileName (str): Optional. Name of the file once downloaded.
+        - sha256 (str): Optional. Expected SHA-256 hash of the file. If given, the download fails if the file does not match it.
+
+        #### Returns:
+        - (dict[str, str]): Dictionary with the file's info.
+
+        #### Usage:
+        installer.getFileDict('https://site.org/file.txt', path='models', sha256='9f86d081884c7d65...')
+        """
+        fileDict = super().getFileDict(url, path=path, fileName=fileName)
+        if sha256:
+            fileDict['sha256'] = sha256
+        return fileDict
+
+    def getExtraFilesBatch(self, fileList: List[Dict[str, str]], binaryName: str, workDir: str='', parallelDownloads: int=8,
+                           segments: int=1, targetName: str=None):
+        """
+        ### This function downloads the given files within a single command.
+        ### If aria2c is installed, up to parallelDownloads files are downloaded at the same time with it. If not, they are downloaded
+        ### with a single wget call per destination folder, so wget reuses the connection for all the files
+        ### coming from the same server instead of opening a new one for each file.
+        ### A SHA-256 manifest of the downloaded files is stored in workDir, so a later install
+        ### only downloads them again if any of them is missing or its content has changed.
+        ### Even then, files whose local copy is up to date with the server are not downloaded again.
+        ### Files with a known hash (see getFileDict) are also checked against it after being downloaded.
+        ### Note: Downloaded files keep the name they have in their url.
+
+        #### Params:
+        - fileList (list[dict[str, str]]): List of files to download, obtained with getFileDict.
+        - binaryName (str): Name of the binary the files belong to. Used to build the default target name.
+        - workDir (str): Optional. Directory where the files will be downloaded from.
+        - parallelDownloads (int): Optional. Maximum number of files downloaded at the same time with aria2c.
+        - segments (int): Optional. Number of connections used by aria2c to download each large file in segments. Default is 1 connection per file.
+        - targetName (str): Optional. Name of the target file for this command.
+
+        #### Returns:
+        - (InstallHelper): Returns itself so it can be chained.
+
+        #### Usage:
+        installer.getExtraFilesBatch([installer.getFileDict('https://site.org/file.txt', path='models')], 'myBinary')
+        """
+        # Grouping urls by destination folder, keeping the given order
+        urlsByPath = {}
+        filePaths = []
+        for fileDict in fileList:
+            urlsByPath.setdefault(fileDict['path'], []).append(fileDict['url'])
+            filePaths.append(os.path.join(fileDict['path'], os.path.basename(fileDict['url'])))
+
+        # Timestamping (-N) overwrites outdated or incomplete files instead of creating numbered copies
+        wgetCmds = []
+        for path, urls in urlsByPath.items():
+            mkdirCmd = f"mkdir -p {path} && " if path != '.' else ''
+            wgetCmds.append(f"{mkdirCmd}wget -N -P {path} {' '.join(urls)}")
+
+        # aria2c reads the list of files to download from stdin, each url followed by its destination folder
+        aria2Input = ' '.join(f"'{fileDict['url']}' '  dir={fileDict['path']}'" for fileDict in fileList)
+        # Files larger than twice the minimum split size are downloaded in segments over several connections (16 at most per server)
+        segments = max(segments, 1)
+        # Conditional get only downloads files again if the server has a newer version, like wget's timestamping
+        aria2Options = (f"-c -j {max(parallelDownloads, 1)} -x {min(segments, 16)} -s {segments} -k 10M "
+            "--conditional-get=true --auto-file-renaming=false --allow-overwrite=true")
+        aria2Cmd = f"printf '%s\\n' {aria2Input} | aria2c {aria2Options} -i -"
+        downloadCmd = f"if command -v aria2c >/dev/null 2>&1; then {aria2Cmd}; else {' && '.join(wgetCmds)}; fi"
+        targetName = targetName if targetName else f"{binaryName.upper()}_EXTRA_FILES"
+
+        # Downloaded files with a known hash must match it
+        knownHashes = ' '.join(f"'{fileDict['sha256']}  {filePath}'" for fileDict, filePath in zip(fileList, filePaths) if fileDict.get('sha256'))
+        if knownHashes:
+            downloadCmd = f"{downloadCmd} && printf '%s\\n' {knownHashes} | {SHA256_PROGRAM} -c -"
+
+        # Files are only downloaded if they do not match the manifest written by a previous install
+        manifest = f".{targetName}.sha256"
+        downloadCmd = f"{downloadCmd} && {SHA256_PROGRAM} {' '.join(filePaths)} > {manifest}"
+        verifyCmd = f"{SHA256_PROGRAM} --status -c {manifest} 2>/dev/null"
+        return self.addCommand(f"({verifyCmd} || ({downloadCmd}))", targetName=targetName, workDir=workDir)
+
+    def extractArchives(self, archiveList: List[str], binaryName: str, workDir: str='', removeArchives: bool=True, parallel: bool=False, targetName: str=None):
+        """
+        ### This function extracts the given tar archives within a single command.
+        ### Gzipped archives are decompressed with pigz if it is available.
+
+        #### Params:
+        - archiveList (list[str]): List of paths to the archives to extract, relative to workDir.
+        - binaryName (str): Name of the binary the archives belong to. Used to build the default target name.
+        - workDir (str): Optional. Directory where the archives will be extracted.
+        - removeArchives (bool): Optional. If True, each archive is removed after being extracted.
+        - parallel (bool): Optional. If True, all archives are extracted at the same time.
+        - targetName (str): Optional. Name of the target file for this command.
+
+        #### Returns:
+        - (InstallHelper): Returns itself so it can be chained.
+
+        #### Usage:
+        installer.extractArchives(['models.tar.gz'], 'myBinary', workDir='/path/to/binary')
+        """
+        extractCmds = []
+        for archive in archiveList:
+            compressOption = f'--use-compress-program="{GZIP_PROGRAM}" ' if archive.endswith(('.gz', '.tgz')) else ''
+            extractCmds.append(f"tar {compressOption}-xf {archive}" + (f" && rm -f {archive}" if removeArchives else ''))
+        targetName = targetName if targetName else f"{binaryName.upper()}_ARCHIVES_EXTRACTED"
+        if parallel:
+            return self.addParallelCommands(extractCmds, targetName, workDir=workDir)
+        return self.addCommand(' && '.join(extractCmds), targetName=targetName, workDir=workDir)
+
+    def addParallelCommands(self, commandList: List[str], targetName: str, workDir: str=''):
+        """
+        ### This function adds a command that runs all the given commands at the same time.
+        ### The command only succeeds if every one of them succeeds.
+
+        #### Params:
+        - commandList (list[str]): List of independent commands to run in parallel.
+        - targetName (str): Name of the target file for this command.
+        - workDir (str): Optional. Directory where the commands will be run from.
+
+        #### Returns:
+        - (InstallHelper): Returns itself so it can be chained.
+
+        #### Usage:
+        installer.addParallelCommands(['git clone https://github.com/user/repo1.git', 'git clone https://github.com/user/repo2.git'], 'REPOS_CLONED')
+        """
+        # Each command is launched in the background, and then all of them are awaited before checking their exit status,
+        # so no command is left running if another one fails
+        launchCmds = ' '.join(f"( {command} ) & pid{idx}=$!;" for idx, command in enumerate(commandList))
+        waitCmds = ' '.join(f"wait $pid{idx}; status{idx}=$?;" for idx in range(len(commandList)))
+        statusCheck = ' && '.join(f"[ $status{idx} -eq 0 ]" for idx in range(len(commandList)))
+        return self.addCommand(f"( {launchCmds} {waitCmds} {statusCheck} )", targetName=targetName, workDir=workDir)
+
+    def getCloneCommand(self, url: str, binaryFolderName: str='', targetName: str=None, depth: int=1):
+        """
+        ### This function clones the given repository.
+        ### Unlike Scipion's version, only the latest commit is fetched by default, as protocols only run the tip of the repository.
+
+        #### Params:
+        - url (str): URL of the git repository.
+        - binaryFolderName (str): Optional. Name of the folder the repository will be cloned into.
+        - targetName (str): Optional. Name of the target file for this command.
+        - depth (int): Optional. Number of commits to fetch. If 0, the whole history is cloned.
+
+        #### Returns:
+        - (InstallHelper): Returns itself so it can be chained.
+
+        #### Usage:
+        installer.getCloneCommand('https://github.com/user/repo.git', binaryFolderName='Repo')
+        """
+        targetName = targetName if targetName else f"{binaryFolderName.upper()}_CLONED"
+        return self.addCommand(self._getCloneCmd(url, binaryFolderName, depth), targetName=targetName)
+
+    def getCloneCommands(self, repoList: List[Tuple[str, str]], binaryName: str, parallel: bool=False, parallelCommands: List[str]=[]):
+        """
+        ### This function clones the given repositories, optionally at the same time.
+
+        #### Params:
+        - repoList (list[tuple[str, str]]): List of (url, binaryFolderName) pairs to clone.
+        - binaryName (str): Name of the binary the repositories belong to. Used to build the target name when cloning in parallel.
+        - parallel (bool): Optional. If True, all repositories are cloned at the same time within a single command.
+        - parallelCommands (list[str]): Optional. Other independent commands to run while cloning. Only used if parallel is True.
+
+        #### Returns:
+        - (InstallHelper): Returns itself so it can be chained.
+
+        #### Usage:
+        installer.getCloneCommands([('https://github.com/user/repo1.git', 'Repo1'), ('https://github.com/user/repo2.git', 'Repo2')], 'myBinary', parallel=True)
+        """
+        if not parallel:
+            for url, binaryFolderName in repoList:
+                self.getCloneCommand(url, binaryFolderName=binaryFolderName)
+            return self
+        cloneCmds = [self._getCloneCmd(url, binaryFolderName) for url, binaryFolderName in repoList]
+        return self.addParallelCommands([*cloneCmds, *parallelCommands], f"{binaryName.upper()}_REPOSITORIES_CLONED")
+
+    def _getCloneCmd(self, url: str, binaryFolderName: str='', depth: int=1) -> str:
+        """
+        ### This function returns the git command to clone the given repository.
+        ### If the destination folder already contains a clone, it is updated to the latest commit instead,
+        ### so the install can be run again without removing it first.
+        ### If a git cache directory was given, the repository is cloned from a local mirror kept there,
+        ### which is created or updated first, so only new commits are downloaded on later installs.
+
+        #### Params:
+        - url (str): URL of the git repository.
+        - binaryFolderName (str): Optional. Name of the folder the repository will be cloned into.
+        - depth (int): Optional. Number of commits to fetch. If 0, the whole history is cloned.
+
+        #### Returns:
+        - (str): The clone command.
+        """
+        destination = binaryFolderName if binaryFolderName else os.path.splitext(os.path.basename(url.rstrip('/')))[0]
+        depthFlag = f" --depth={depth}" if depth else ''
+        shallowFlags = f"{depthFlag} --single-branch --no-tags" if depth else ''
+        updateCmd = f"git -C {destination} fetch{depthFlag} origin HEAD && git -C {destination} reset --hard FETCH_HEAD"
+        cloneCmd = f"git clone{shallowFlags} {url} {destination}"
+        if self._gitCacheDir:
+            # Failing to update an existing mirror (e.g. when offline) should not stop the install
+            mirror = os.path.join(self._gitCacheDir, os.path.basename(url.rstrip('/')))
+            mirrorCmd = f"if [ -d {mirror} ]; then (git -C {mirror} remote update --prune || true); else mkdir -p {self._gitCacheDir} && git clone --mirror {url} {mirror}; fi"
+            cloneCmd = f"{mirrorCmd} && git clone{shallowFlags} file://{mirror} {destination} && git -C {destination} remote set-url origin {url}"
+        return f"if [ -d {destination}/.git ]; then {updateCmd}; else {cloneCmd}; fi"
@@ -9,3 +9,5 @@ from .protocol_emap2sec import ProtEmap2sec
 from .protocol_mainmast_segment_map import ProtMainMastSegmentMap
 from .protocol_cryoread import ProtCryoREAD
 from .protocol_dmm import ProtDMM
+
+__all__ = ['ProtDAQValidation', 'ProtEmap2sec', 'ProtMainMastSegmentMap', 'ProtCryoREAD', 'ProtDMM']
@@ -25,17 +25,18 @@
 # *
 # **************************************************************************
 
-import os, shutil
+import errno, os, shutil
+from functools import cached_property
 
 from pyworkflow.protocol import params
 from pyworkflow.utils import Message
 from pwem.protocols import EMProtocol
 from pwem.objects import AtomStruct
 from pwem.convert import Ccp4Header
-from pwem.convert.atom_struct import toCIF, AtomicStructHandler, addScipionAttribute
-from pwem.emlib.image import ImageHandler
+from pwem.convert.atom_struct import toCIF
 
 from kiharalab import Plugin
+from kiharalab.utils import parseResidueScores, writeScipionAttribute, convertIfChanged
 
 class ProtCryoREAD(EMProtocol):
     """
@@ -97,16 +98,10 @@ class ProtCryoREAD(EMProtocol):
         inVol = self._getInputVolume()
         inVolFile, inVolSR = inVol.getFileName(), inVol.getSamplingRate()
 
-        # Convert volume to mrc
-        mrcFile = self._getTmpPath('inpVolume.mrc')
-        ImageHandler().convert(inVolFile, mrcFile)
-        Ccp4Header.fixFile(mrcFile, mrcFile, inVol.getOrigin(force=True).getShifts(),
-                           inVolSR, Ccp4Header.START)
-
-
-        # Volume header fixed to have correct origin
-        Ccp4Header.fixFile(mrcFile, self.getLocalVolumeFile(), inVol.getOrigin(force=True).getShifts(), inVolSR,
-                           Ccp4Header.ORIGIN)
+        # Convert volume to mrc with its header fixed to have correct origin, in a single pass.
+        # Setting the origin resets the start fields, so fixing them first had no effect on the result
+        Ccp4Header.fixFile(inVolFile, self.getLocalVolumeFile(), inVol.getOrigin(force=True).getShifts(),
+                           inVolSR, Ccp4Header.ORIGIN)
 
     def cryoREADStep(self):
         inputFilePath = self.getLocalVolumeFile()
@@ -116,7 +111,7 @@ class ProtCryoREAD(EMProtocol):
         outDir = self._getTmpPath('predictions')
         args = self.getcryoREADArgs()
 
-        envActivationCommand = f"{Plugin.getCondaActivationCmd()} {Plugin.getProtocolActivationCommand('cryoREAD')}"
+        envActivationCommand = Plugin.getProtocolFullActivationCommand('cryoREAD')
         fullProgram = f'{envActivationCommand} && python3'
 
         if 'main.py' not in args:
@@ -125,24 +120,24 @@ class ProtCryoREAD(EMProtocol):
         print(f'Running CryoREAD with input file: {inputFilePath}')
         self.runJob(fullProgram, args, cwd=Plugin._cryoREADBinary)
 
-        if outDir is None:
-            outDir = self._getExtraPath('predictions')
-
-        cryoDir = os.path.join(Plugin._cryoREADBinary, 'Predict_Result', self.getVolumeName())
-        shutil.copytree(cryoDir, outDir)
-        shutil.rmtree(cryoDir)
+        cryoDir = os.path.join(Plugin._cryoREADPredictResult, self.getVolumeName())
+        try:
+            # Moving the folder is a single rename when both paths are on the same filesystem
+            os.replace(cryoDir, outDir)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copytree(cryoDir, outDir)
+            shutil.rmtree(cryoDir)
 
     def createOutputStep(self):
         outStructFileName = self._getPath('CryoREAD.cif')
         outPdbFileName = os.path.abspath(self._getTmpPath('predictions/CryoREAD_norefine.pdb'))
 
-        ASH = AtomicStructHandler()
         cryoScoresDic = self.parseCryoScores(outPdbFileName)
 
-        outputVolume = toCIF(outPdbFileName, self._getTmpPath('inputStruct.cif'))
-        cifDic = ASH.readLowLevel(outputVolume)
-        cifDic = addScipionAttribute(cifDic, cryoScoresDic, self._ATTRNAME)
-        ASH._writeLowLevel(outStructFileName, cifDic)
+        outputVolume = convertIfChanged(toCIF, outPdbFileName, self._getTmpPath('inputStruct.cif'))
+        writeScipionAttribute(outputVolume, outStructFileName, cryoScoresDic, self._ATTRNAME)
 
         # Create AtomStruct object with the CIF file
         AS = AtomStruct(filename=outStructFileName)
@@ -171,9 +166,8 @@ class ProtCryoREAD(EMProtocol):
     # --------------------------- UTILS functions -----------------------------------
     def getcryoREADArgs(self):
         args = (f' --mode=0 -F={self.getLocalVolumeFile()} -M={Plugin._cryoREADBinary}/best_model '
-                f'--contour={self.contour_level.get()} --resolution={self.resolution.get()}')
-
-        args += f' --batch_size={self.batch_size.get()} --rule_soft={self.rule_soft.get()} --thread={self.thread.get()}'
+                f'--contour={self.contour_level.get()} --resolution={self.resolution.get()}'
+                f' --batch_size={self.batch_size.get()} --rule_soft={self.rule_soft.get()} --thread={self.thread.get()}')
 
         if self.inputSequence.hasValue():
             args += f' -P={self.getFastaFilePath()}'
@@ -189,12 +183,25 @@ class ProtCryoREAD(EMProtocol):
         return self.inputVolume.get()
 
     def getVolumeFile(self):
-        return os.path.abspath(self._getInputVolume().getFileName())
+        return self._volumeFile
 
     def getVolumeName(self):
-        return os.path.basename(os.path.splitext(self.getLocalVolumeFile())[0])
+        return self._volumeName
 
     def getLocalVolumeFile(self):
+        return self._localVolumeFile
+
+    # Paths are computed only once per protocol instance, since inputs do not change while running
+    @cached_property
+    def _volumeFile(self):
+        return os.path.abspath(self._getInputVolume().getFileName())
+
+    @cached_property
+    def _volumeName(self):
+        return os.path.basename(os.path.splitext(self.getLocalVolumeFile())[0])
+
+    @cached_property
+    def _localVolumeFile(self):
         oriName = os.path.basename(os.path.splitext(self.getVolumeFile())[0])
         localPath = self._getExtraPath(f'{oriName}_{self.getObjId()}.mrc')
         return os.path.abspath(localPath)
@@ -206,12 +213,4 @@ class ProtCryoREAD(EMProtocol):
         return getattr(self, params.GPU_LIST).get().split(',')
 
     def parseCryoScores(self, pdbFile):
-        cryoDic = {}
-        with open(pdbFile) as f:
-            for line in f:
-                if line.startswith('ATOM') or line.startswith('HETATM'):
-                    resId = f'{line[21].strip()}:{line[22:26].strip()}'
-                    if resId not in cryoDic:
-                        cryoScore = line[60:66].strip()
-                        cryoDic[resId] = cryoScore
-        return cryoDic
+        return parseResidueScores(pdbFile)
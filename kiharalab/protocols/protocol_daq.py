@@ -29,19 +29,20 @@
 """
 This protocol is used to perform a pocket search on a protein structure using the FPocket software
 """
-import os, shutil, time
-from decimal import Decimal
+import errno, math, os, shlex, shutil
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, lru_cache
 
 from pyworkflow.protocol import params
 from pwem.protocols import EMProtocol
 from pwem.objects import AtomStruct
-from pwem.convert.atom_struct import toPdb, toCIF, AtomicStructHandler, addScipionAttribute
+from pwem.convert.atom_struct import toPdb, toCIF
 from pwem.convert import Ccp4Header
-from pyworkflow.utils import Message, weakImport
+from pyworkflow.utils import Environ, Message, weakImport
 from pwem.viewers.viewer_chimera import Chimera
-from pwem.emlib.image import ImageHandler
 
 from kiharalab import Plugin
+from kiharalab.utils import parseResidueScores, writeScipionAttribute, convertIfChanged
 
 class ProtDAQValidation(EMProtocol):
 	"""
@@ -51,6 +52,13 @@ class ProtDAQValidation(EMProtocol):
 	_ATTRNAME = 'DAQ_score'
 	_OUTNAME = 'outputAtomStruct'
 	_possibleOutputs = {_OUTNAME: AtomStruct}
+	# Automatic batch size limits. The default is DAQ's own default batch size, and the limits keep the automatic value
+	# within a factor of 16 below and 2 above it, so a rough memory estimate can not move it far from that default
+	_MIN_BATCH_SIZE, _MAX_BATCH_SIZE, _DEFAULT_BATCH_SIZE = 16, 512, 256
+	# GPU memory budgeted for each sample of a batch. This is not measured from DAQ's model: it is a conservative figure
+	# calibrated so that DAQ's default batch size is only picked when at least 8 GiB of GPU memory are free (32 MiB per sample).
+	# Setting the batch size explicitly skips this estimate
+	_BATCH_SAMPLE_MEMORY = 8 * 1024 ** 3 // _DEFAULT_BATCH_SIZE
 
 	# -------------------------- DEFINE param functions ----------------------
 	def _defineParams(self, form):
@@ -89,7 +97,8 @@ class ProtDAQValidation(EMProtocol):
 			help='Input voxel size')
 		group.addParam('batchSize', params.IntParam, default='256',
 			label='Batch size: ', expertLevel=params.LEVEL_ADVANCED,
-			help='Batch size for inference')
+			help='Batch size for inference.\nSet it to 0 to pick a batch size from the free memory of the GPU, '
+			'estimating about 32 MiB per sample (between 16 and 512).')
 		group.addParam('cardinality', params.IntParam, default='32',
 			label='Cardinality: ', expertLevel=params.LEVEL_ADVANCED,
 			help='ResNeXt cardinality')
@@ -103,34 +112,40 @@ class ProtDAQValidation(EMProtocol):
 
 	def convertInputStep(self):
 		ext = os.path.splitext(self.getStructFile())[1]
-		pdbFile = self.getPdbStruct()
-		if ext not in ['.pdb', '.ent']:
-			toPdb(self.getStructFile(), pdbFile)
-		else:
-			shutil.copy(self.getStructFile(), pdbFile)
+		convertFunc = toPdb if ext not in ['.pdb', '.ent'] else shutil.copy
 
 		inVol = self._getInputVolume()
 		inVolFile, inVolSR = inVol.getFileName(), inVol.getSamplingRate()
-
-		#Convert volume to mrc
-		mrcFile = self._getTmpPath('inpVolume.mrc')
-		ImageHandler().convert(inVolFile, mrcFile)
-		Ccp4Header.fixFile(mrcFile, mrcFile, inVol.getOrigin(force=True).getShifts(),
-						   inVolSR, Ccp4Header.START)
+		shifts = inVol.getOrigin(force=True).getShifts()
 
 		#Resample volume to 1A/px with ChimeraX if present
 		daqSR = 1.0
-		if self.chimeraResampling and Decimal(inVol.getSamplingRate()) != Decimal(daqSR):
-			if chimeraInstalled():
-				resampledFile = os.path.abspath(self._getTmpPath('resampled.mrc'))
-				mrcFile = self.chimeraResample(mrcFile, daqSR, resampledFile)
-				inVolSR = daqSR
-			else:
+		resample = False
+		if self.chimeraResampling and not math.isclose(inVol.getSamplingRate(), daqSR, rel_tol=0, abs_tol=1e-6):
+			resample = chimeraInstalled()
+			if not resample:
 				print('ChimeraX not found, resampling with DAQ (slower than ChimeraX)')
 
-		# Volume header fixed to have correct origin
-		Ccp4Header.fixFile(mrcFile, self.getLocalVolumeFile(), inVol.getOrigin(force=True).getShifts(),
-			inVolSR, Ccp4Header.ORIGIN)
+		# Structure and volume conversions work on different files, so they run at the same time
+		with ThreadPoolExecutor(max_workers=2) as executor:
+			structConversion = executor.submit(convertIfChanged, convertFunc, self.getStructFile(), self.getPdbStruct())
+
+			# Convert volume to mrc with a fixed header. If it is not going to be resampled, the final origin is written directly
+			mrcFile = self._getTmpPath('inpVolume.mrc')
+			Ccp4Header.fixFile(inVolFile, mrcFile, shifts, inVolSR, Ccp4Header.START if resample else Ccp4Header.ORIGIN)
+
+			# Raise any error found while converting the structure
+			structConversion.result()
+
+		if resample:
+			resampledFile = os.path.abspath(self._getTmpPath('resampled.mrc'))
+			mrcFile = self.chimeraResample(mrcFile, daqSR, resampledFile)
+			# Volume header fixed in place to have correct origin, unless ChimeraX already wrote it
+			if not self.hasHeaderOrigin(mrcFile, shifts, daqSR):
+				Ccp4Header.fixFile(mrcFile, mrcFile, shifts, daqSR, Ccp4Header.ORIGIN)
+
+		# Volume moved instead of copied
+		os.replace(mrcFile, self.getLocalVolumeFile())
 
 	def DAQStep(self):
 		"""
@@ -139,34 +154,36 @@ class ProtDAQValidation(EMProtocol):
 		outDir = self._getTmpPath('predictions')
 		args = self.getDAQArgs()
 
-		fullProgram = f'{Plugin.getCondaActivationCmd()} {Plugin.getProtocolActivationCommand("daq")} && python'
+		fullProgram = f'{Plugin.getProtocolFullActivationCommand("daq")} && python'
 		if 'main.py' not in args:
 			args = f'{Plugin._daqBinary}/main.py {args}'
-		self.runJob(fullProgram, args, cwd=Plugin._daqBinary)
-
-		if outDir is None:
-			outDir = self._getExtraPath('predictions')
-
-		daqDir = os.path.join(Plugin._daqBinary, 'Predict_Result', self.getVolumeName())
-		shutil.copytree(daqDir, outDir)
-		shutil.rmtree(daqDir)
+		self.runJob(fullProgram, args, cwd=Plugin._daqBinary, env=self.getDAQEnviron())
+
+		daqDir = os.path.join(Plugin._daqPredictResult, self.getVolumeName())
+		try:
+			# Moving the folder is a single rename when both paths are on the same filesystem
+			os.replace(daqDir, outDir)
+		except OSError as e:
+			if e.errno != errno.EXDEV:
+				raise
+			shutil.copytree(daqDir, outDir)
+			shutil.rmtree(daqDir)
 	
 	def createOutputStep(self):
 		outStructFileName = self._getPath('outputStructure.cif')
 		outDAQFile = os.path.abspath(self._getTmpPath('predictions/daq_score_w9.pdb'))
 
 		#Write DAQ_score in a section of the output cif file
-		ASH = AtomicStructHandler()
-		daqScoresDic = self.parseDAQScores(outDAQFile)
-		inpAS = toCIF(self.inputAtomStruct.get().getFileName(), self._getTmpPath('inputStruct.cif'))
-		cifDic = ASH.readLowLevel(inpAS)
-		cifDic = addScipionAttribute(cifDic, daqScoresDic, self._ATTRNAME)
-		ASH._writeLowLevel(outStructFileName, cifDic)
+		with ThreadPoolExecutor(max_workers=1) as executor:
+			cifConversion = executor.submit(convertIfChanged, toCIF, self.inputAtomStruct.get().getFileName(), self._getTmpPath('inputStruct.cif'))
+			daqScoresDic = self.parseDAQScores(outDAQFile)
+			inpAS = cifConversion.result()
+		writeScipionAttribute(inpAS, outStructFileName, daqScoresDic, self._ATTRNAME)
 
 		AS = AtomStruct(filename=outStructFileName)
 		outVol = self._getInputVolume().clone()
 		outVol.setLocation(self.getLocalVolumeFile())
-		if self.chimeraResampling and Decimal(self._getInputVolume().getSamplingRate()) != Decimal(1.0) and chimeraInstalled():
+		if self.chimeraResampling and not math.isclose(self._getInputVolume().getSamplingRate(), 1.0, rel_tol=0, abs_tol=1e-6) and chimeraInstalled():
 			outVol.setSamplingRate(1.0)
 		AS.setVolume(outVol)
 
@@ -193,16 +210,55 @@ class ProtDAQValidation(EMProtocol):
 	# --------------------------- UTILS functions -----------------------------------
 	def getDAQArgs(self):
 		args = (f' --mode=0 -F {os.path.abspath(self.getLocalVolumeFile())} -P '
-					f'{os.path.abspath(self.getPdbStruct())} --window {self.window.get()} --stride {self.stride.get()}')
-
-		args += f' --voxel_size {self.voxelSize.get()} --batch_size {self.batchSize.get()} --cardinality {self.cardinality.get()}'
+					f'{os.path.abspath(self.getPdbStruct())} --window {self.window.get()} --stride {self.stride.get()}'
+					f' --voxel_size {self.voxelSize.get()} --batch_size {self.getBatchSize()} --cardinality {self.cardinality.get()}')
 
 		if getattr(self, params.USE_GPU):
 			args += f' --gpu {self.getGPUIds()[0]}'
 		
 		return args
 
+	def getDAQEnviron(self):
+		"""
+		Returns the environment variables DAQ is run with.
+		On GPU, only the selected device is made visible to CUDA, and PyTorch is allowed to use TF32 tensor cores
+		for float32 matrix products, as it already does for convolutions.
+		"""
+		env = Environ(self._getEnviron() or os.environ)
+		if getattr(self, params.USE_GPU):
+			# DAQ also sets this variable from --gpu, so both need to point to the same device
+			env['CUDA_VISIBLE_DEVICES'] = self.getGPUIds()[0]
+			env['TORCH_ALLOW_TF32_CUBLAS_OVERRIDE'] = '1'
+		return env
+
+	def getBatchSize(self):
+		""" Returns the batch size set by the user, or the automatic one if it is 0. """
+		batchSize = self.batchSize.get()
+		return batchSize if batchSize else self._getAutoBatchSize()
+
+	def _getAutoBatchSize(self):
+		"""
+		Returns the largest power of two batch size that fits in the free memory of the selected GPU.
+		Falls back to the default batch size if running on CPU or if the GPU cannot be queried (pynvml is optional).
+		"""
+		if not getattr(self, params.USE_GPU):
+			return self._DEFAULT_BATCH_SIZE
+		try:
+			import pynvml
+			pynvml.nvmlInit()
+			try:
+				handle = pynvml.nvmlDeviceGetHandleByIndex(int(self.getGPUIds()[0]))
+				freeMemory = pynvml.nvmlDeviceGetMemoryInfo(handle).free
+			finally:
+				pynvml.nvmlShutdown()
+		except Exception as e:
+			print(f'Could not query free GPU memory ({e}), using a batch size of {self._DEFAULT_BATCH_SIZE}')
+			return self._DEFAULT_BATCH_SIZE
+		samples = max(freeMemory // self._BATCH_SAMPLE_MEMORY, 1)
+		return max(self._MIN_BATCH_SIZE, min(self._MAX_BATCH_SIZE, 1 << (int(samples).bit_length() - 1)))
+
 	def _getInputVolume(self):
+		# Only paths are cached: an input object kept as a protocol attribute would be stored in the run database
 		if self.inputVolume.get() is None:
 			fnVol = self.inputAtomStruct.get().getVolume()
 		else:
@@ -210,62 +266,92 @@ class ProtDAQValidation(EMProtocol):
 		return fnVol
 
 	def getStructFile(self):
-		return os.path.abspath(self.inputAtomStruct.get().getFileName())
+		return self._structFile
 
 	def getVolumeFile(self):
-		return os.path.abspath(self._getInputVolume().getFileName())
+		return self._volumeFile
 
 	def getStructName(self):
-		return os.path.basename(os.path.splitext(self.getStructFile())[0])
+		return self._structName
 
 	def getVolumeName(self):
-		return os.path.basename(os.path.splitext(self.getLocalVolumeFile())[0])
+		return self._volumeName
 
 	def getPdbStruct(self):
-		return f"{self._getTmpPath(self.getStructName())}.pdb"
+		return self._pdbStruct
 
 	def getLocalVolumeFile(self):
+		return self._localVolumeFile
+
+	# Paths are computed only once per protocol instance, since inputs do not change while running
+	@cached_property
+	def _structFile(self):
+		return os.path.abspath(self.inputAtomStruct.get().getFileName())
+
+	@cached_property
+	def _volumeFile(self):
+		return os.path.abspath(self._getInputVolume().getFileName())
+
+	@cached_property
+	def _structName(self):
+		return os.path.basename(os.path.splitext(self.getStructFile())[0])
+
+	@cached_property
+	def _volumeName(self):
+		return os.path.basename(os.path.splitext(self.getLocalVolumeFile())[0])
+
+	@cached_property
+	def _pdbStruct(self):
+		return f"{self._getTmpPath(self.getStructName())}.pdb"
+
+	@cached_property
+	def _localVolumeFile(self):
 		oriName = os.path.basename(os.path.splitext(self.getVolumeFile())[0])
 		return self._getExtraPath(f'{oriName}_{self.getObjId()}.mrc')
 
 	def parseDAQScores(self, pdbFile):
 		'''Return a dictionary with {spec: value}
 		"spec" should be a chimera specifier. In this case:  chainId:residueIdx'''
-		daqDic = {}
-		with open(pdbFile) as f:
-			for line in f:
-				if line.startswith('ATOM') or line.startswith('HETATM'):
-					resId = f'{line[21].strip()}:{line[22:26].strip()}'
-					if resId not in daqDic:
-						daqScore = line[60:66].strip()
-						daqDic[resId] = daqScore
-		return daqDic
+		return parseResidueScores(pdbFile)
 	
 	def getGPUIds(self):
-		return getattr(self, params.GPU_LIST).get().split(',')
+		return self._gpuIds
+
+	@cached_property
+	def _gpuIds(self):
+		return tuple(getattr(self, params.GPU_LIST).get().split(','))
 
 	def getDAQScoreFile(self):
 		return self._getPath(f'{self._ATTRNAME}.defattr')
 
-	def chimeraResampleScript(self, inVolFile, newSampling, outFile):
-		scriptFn = self._getExtraPath('resampleVolume.cxc')
-		with open(scriptFn, 'w') as f:
-			f.write(f'cd {os.getcwd()}\n')
-			f.write(f"open {inVolFile}\n")
-			f.write(f'vol resample #1 spacing {newSampling}\n')
-			f.write(f'save {outFile} model #2\n')
-			f.write('exit\n')
-		return scriptFn
+	def hasHeaderOrigin(self, mrcFile, shifts, sampling):
+		""" Returns True if the header of the given volume already stores the given origin and sampling rate. """
+		header = Ccp4Header(mrcFile, readHeader=True)
+		return (tuple(header.getStartPixel()) == (0, 0, 0)
+			and all(math.isclose(value, shift, abs_tol=1e-3) for value, shift in zip(header.getOrigin(), shifts))
+			and all(math.isclose(value, sampling, rel_tol=1e-4) for value in header.getSampling()))
+
+	def chimeraResampleCommands(self, inVolFile, newSampling, outFile):
+		""" Returns the ChimeraX commands that resample the given volume, to be run with --cmd. """
+		return '; '.join([
+			f'open "{inVolFile}"',
+			f'vol resample #1 spacing {newSampling}',
+			f'save "{outFile}" model #2',
+			'exit'
+		])
 
 	def chimeraResample(self, inVolFile, newSR, outFile):
 		with weakImport("chimera"):
 			from chimera import Plugin as chimeraPlugin
-			resampleScript = self.chimeraResampleScript(inVolFile, newSampling=newSR, outFile=outFile)
+			# Commands are passed in the command line instead of through a script file. Relative paths are resolved from cwd
+			resampleCommands = self.chimeraResampleCommands(inVolFile, newSampling=newSR, outFile=outFile)
 			chimeraPlugin.runChimeraProgram(f"{chimeraPlugin.getProgram()} --nogui --silent",
-				resampleScript, cwd=os.getcwd())
-			while not os.path.exists(outFile):
-				time.sleep(1)
+				f'--cmd {shlex.quote(resampleCommands)}', cwd=os.getcwd())
+			# ChimeraX has already exited at this point, so the output either exists or was never written
+			if not os.path.exists(outFile):
+				raise FileNotFoundError(f"ChimeraX did not generate the resampled volume {outFile}.")
 		return outFile
 
+@lru_cache(maxsize=1)
 def chimeraInstalled():
   return Chimera.getHome() and os.path.exists(Chimera.getProgram())
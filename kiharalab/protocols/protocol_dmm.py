@@ -30,16 +30,17 @@
 This protocol is used to perform a pocket search on a protein structure using the FPocket software
 """
 import os, shutil
+from functools import cached_property
 
 from pyworkflow.protocol import params
 from pyworkflow.utils import Message
 from pwem.protocols import EMProtocol
 from pwem.objects import AtomStruct
 from pwem.convert import Ccp4Header
-from pwem.convert.atom_struct import toCIF, AtomicStructHandler, addScipionAttribute
-from pwem.emlib.image import ImageHandler
+from pwem.convert.atom_struct import toCIF
 
 from kiharalab import Plugin
+from kiharalab.utils import parseResidueScores, writeScipionAttribute, convertIfChanged
 
 class ProtDMM(EMProtocol):
     """
@@ -49,6 +50,7 @@ class ProtDMM(EMProtocol):
     _ATTRNAME = 'DMM_score'
     _OUTNAME = 'outputAtomStruct'
     _possibleOutputs = {_OUTNAME: AtomStruct}
+    stepsExecutionMode = params.STEPS_PARALLEL
 
     # -------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -93,26 +95,35 @@ class ProtDMM(EMProtocol):
                 label="AlphaFold2 Structure: ",
                 help='Select the corresponding af2 structure')
 
+        form.addParallelSection(threads=3, mpi=0)
+
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
-        self._insertFunctionStep('convertInputStep')
-        self._insertFunctionStep('DMMStep')
-        self._insertFunctionStep('createOutputStep')
+        # Volume conversion and sequence staging are independent, so they can run at the same time.
+        # Only DMM itself uses the GPU, so the other steps do not wait for a free GPU slot
+        convertStep = self._insertFunctionStep('convertInputStep', prerequisites=[], needsGPU=False)
+        sequenceStep = self._insertFunctionStep('stageSequenceStep', prerequisites=[], needsGPU=False)
+        dmmStep = self._insertFunctionStep('DMMStep', prerequisites=[convertStep, sequenceStep])
+        self._insertFunctionStep('createOutputStep', prerequisites=[dmmStep], needsGPU=False)
 
     def convertInputStep(self):
         inVol = self._getInputVolume()
         inVolFile, inVolSR = inVol.getFileName(), inVol.getSamplingRate()
 
-        #Convert volume to mrc
-        mrcFile = self._getTmpPath('inpVolume.mrc')
-        ImageHandler().convert(inVolFile, mrcFile)
-        Ccp4Header.fixFile(mrcFile, mrcFile, inVol.getOrigin(force=True).getShifts(),
-                           inVolSR, Ccp4Header.START)
-
-        # Volume header fixed to have correct origin
-        Ccp4Header.fixFile(mrcFile, self.getLocalVolumeFile(), inVol.getOrigin(force=True).getShifts(),
+        # Convert volume to mrc with its header fixed to have correct origin, in a single pass.
+        # Setting the origin resets the start fields, so fixing them first had no effect on the result
+        Ccp4Header.fixFile(inVolFile, self.getLocalVolumeFile(), inVol.getOrigin(force=True).getShifts(),
                            inVolSR, Ccp4Header.ORIGIN)
 
+    def stageSequenceStep(self):
+        """
+        Makes the input sequence available in the extra folder.
+        """
+        sequenceFile, localSequenceFile = self.getSequenceFile(), os.path.abspath(self.getLocalSequenceFile())
+        # A sequence staged in a previous run is reused if the input has not changed since then
+        if not os.path.exists(localSequenceFile) or not self._isSameFile(sequenceFile, localSequenceFile):
+            self._linkFile(sequenceFile, localSequenceFile)
+
     def DMMStep(self):
         print("in dmm step")
 
@@ -121,11 +132,11 @@ class ProtDMM(EMProtocol):
         """
         programPath = Plugin._DMMBinary
         args = self.getDMMArgs()
-        forGpu = ""
+        envActivationCommand = Plugin.getProtocolFullActivationCommand('dmm')
+        fullProgram = f'{envActivationCommand} && {Plugin._DMMBinary}/dmm_full_multithreads.sh'
         if getattr(self, params.USE_GPU):
-            forGpu = 'export CUDA_VISIBLE_DEVICES={}'.format(self.getGPUIds()[0])
-        envActivationCommand = f"{Plugin.getCondaActivationCmd()} {Plugin.getProtocolActivationCommand('dmm')}"
-        fullProgram = f'{forGpu} && {envActivationCommand} && {Plugin._DMMBinary}/dmm_full_multithreads.sh'
+            # All selected GPUs are made visible, so DMM can use them
+            fullProgram = f'export CUDA_VISIBLE_DEVICES={",".join(self.getGPUIds())} && {fullProgram}'
 
         if 'dmm_full_multithreads.sh' not in args:
             args = f'-o predictions -p {Plugin._DMMBinary}{args}'
@@ -153,13 +164,10 @@ class ProtDMM(EMProtocol):
         outStructFileName = self._getPath('Deepmainmast.cif')
         outPdbFileName = os.path.abspath(self._getTmpPath('predictions/DeepMainmast.pdb'))
 
-        ASH = AtomicStructHandler()
         cryoScoresDic = self.parseDMMScores(outPdbFileName)
 
-        outputVolume = toCIF(outPdbFileName, self._getTmpPath('inputStruct.cif'))
-        cifDic = ASH.readLowLevel(outputVolume)
-        cifDic = addScipionAttribute(cifDic, cryoScoresDic, self._ATTRNAME)
-        ASH._writeLowLevel(outStructFileName, cifDic)
+        outputVolume = convertIfChanged(toCIF, outPdbFileName, self._getTmpPath('inputStruct.cif'))
+        writeScipionAttribute(outputVolume, outStructFileName, cryoScoresDic, self._ATTRNAME)
 
         # Create AtomStruct object with the CIF file
         AS = AtomStruct(filename=outStructFileName)
@@ -184,52 +192,81 @@ class ProtDMM(EMProtocol):
         return self.inputSeq.get()
 
     def getStructFile(self):
-        return os.path.abspath(self.inputAtomStruct.get().getFileName())
+        return self._structFile
 
     def getVolumeFile(self):
-        return os.path.abspath(self._getInputVolume().getFileName())
+        return self._volumeFile
     
     def getSequenceFile(self):    
         return self._getinputSeq()
 
     def getStructName(self):
-        return os.path.basename(os.path.splitext(self.getStructFile())[0])
+        return self._structName
 
     def getVolumeName(self):
-        return os.path.basename(os.path.splitext(self.getLocalVolumeFile())[0])
+        return self._volumeName
 
     def getPdbStruct(self):
-        return f"{self._getTmpPath(self.getStructName())}.pdb"
+        return self._pdbStruct
 
     def getLocalVolumeFile(self):
-        oriName = os.path.basename(os.path.splitext(self.getVolumeFile())[0])
-        return self._getExtraPath(f'{oriName}_{self.getObjId()}.mrc')
+        return self._localVolumeFile
     
     def getLocalSequenceFile(self):
-        
+        return self._localSequenceFile
+
+    @cached_property
+    def _structFile(self):
+        return os.path.abspath(self.inputAtomStruct.get().getFileName())
+
+    @cached_property
+    def _volumeFile(self):
+        return os.path.abspath(self._getInputVolume().getFileName())
+
+    @cached_property
+    def _structName(self):
+        return os.path.basename(os.path.splitext(self.getStructFile())[0])
+
+    @cached_property
+    def _volumeName(self):
+        return os.path.basename(os.path.splitext(self.getLocalVolumeFile())[0])
+
+    @cached_property
+    def _pdbStruct(self):
+        return f"{self._getTmpPath(self.getStructName())}.pdb"
+
+    @cached_property
+    def _localVolumeFile(self):
+        oriName = os.path.basename(os.path.splitext(self.getVolumeFile())[0])
+        return self._getExtraPath(f'{oriName}_{self.getObjId()}.mrc')
+
+    @cached_property
+    def _localSequenceFile(self):
         oriName = os.path.basename(os.path.splitext(self.getSequenceFile())[0])
-        extrapath = self._getExtraPath(f'{oriName}_{self.getObjId()}.fasta')
-        parts = extrapath.split('/')
-        res = '/'.join(parts[:-1])
-        print("HAHA")
-        print(os.path.abspath(extrapath))
-        print(os.path.abspath(res))
-        shutil.copyfile(self.getSequenceFile(),os.path.abspath(extrapath))
-        return extrapath
+        return self._getExtraPath(f'{oriName}_{self.getObjId()}.fasta')
+
+    def _linkFile(self, srcFile, dstFile):
+        """ Makes the given file available at the destination path with a hard link, or with a symlink or a copy if not possible. """
+        if os.path.lexists(dstFile):
+            os.remove(dstFile)
+        try:
+            os.link(srcFile, dstFile)
+        except OSError:
+            try:
+                os.symlink(os.path.abspath(srcFile), dstFile)
+            except OSError:
+                # The copy keeps the modification time, so it is still detected as the same file
+                shutil.copy2(srcFile, dstFile)
+
+    def _isSameFile(self, srcFile, dstFile):
+        srcStat, dstStat = os.stat(srcFile), os.stat(dstFile)
+        return srcStat.st_size == dstStat.st_size and srcStat.st_mtime_ns == dstStat.st_mtime_ns
 
 
     def parseDMMScores(self, pdbFile):
         '''Return a dictionary with {spec: value}
         "spec" should be a chimera specifier. In this case:  chainId:residueIdx'''
-        dmmDic = {}
-        with open(pdbFile) as f:
-            for line in f:
-                if line.startswith('ATOM') or line.startswith('HETATM'):
-                    resId = f'{line[21].strip()}:{line[22:26].strip()}'
-                    if resId not in dmmDic:
-                      dmmScore = line[60:66].strip()
-                      dmmDic[resId] = dmmScore
-        return dmmDic
+        return parseResidueScores(pdbFile)
     
     def getGPUIds(self):
         return getattr(self, params.GPU_LIST).get().split(',')
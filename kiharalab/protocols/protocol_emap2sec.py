@@ -189,52 +189,40 @@ class ProtEmap2sec(EMProtocol):
 		"""
 		Run Emap2sec script from a given protocol.
 		"""
-		envActivationCommand = f"{Plugin.getCondaActivationCmd()} {Plugin.getProtocolActivationCommand('emap2sec')}"
-		
+		envActivationCommand = Plugin.getProtocolFullActivationCommand('emap2sec')
+
+		# All steps run in a single shell, so conda is only activated once
+		steps = [
+			f"data_generate/map2train {args[0]}",
+			envActivationCommand,
+			f"python data_generate/dataset.py {args[1]}",
+			f"echo {args[2]}",
+			f"python emap2sec/Emap2sec.py {args[3]}",
+			f"Visual/Visual.pl {args[4]}"
+		]
 		if outDir:
-			self.runJob("mkdir -p", outDir, cwd=Plugin._emap2secBinary)
-
-		moveToRepoCommand = "cd"
-		self.runJob(moveToRepoCommand, Plugin._emap2secBinary, cwd=Plugin._emap2secBinary)
-
-		trimappCommand = "data_generate/map2train"
-		self.runJob(trimappCommand, args[0], cwd=Plugin._emap2secBinary)
-
-		datasetCommand = f"{envActivationCommand} && python data_generate/dataset.py"
-		self.runJob(datasetCommand, args[1], cwd=Plugin._emap2secBinary)
+			steps.insert(0, f"mkdir -p {outDir}")
+		self.runJob(' && '.join(steps), '', cwd=Plugin._emap2secBinary)
 
-		self.runJob("echo", args[2], cwd=Plugin._emap2secBinary)
-
-		emap2secCommand = f"{envActivationCommand} && python emap2sec/Emap2sec.py"
-		self.runJob(emap2secCommand, args[3], cwd=Plugin._emap2secBinary)
-		
-		visualCommand = "Visual/Visual.pl"
-		self.runJob(visualCommand, args[4], cwd=Plugin._emap2secBinary)
-
-		if clean:
-			for tmpFile in args[5]:
-				self.runJob("rm -rf", tmpFile, cwd=Plugin._emap2secBinary)
+		if clean and args[5]:
+			self.runJob("rm -rf", ' '.join(args[5]), cwd=Plugin._emap2secBinary)
 	
 	# ---------------------------------- Emap2sec+ ----------------------------------
 	def runEmap2secPlus(self, args, clean=True):
 		"""
 		Run Emap2secPlus script from a given protocol.
 		"""
-		envActivationCommand = f"{Plugin.getCondaActivationCmd()} {Plugin.getProtocolActivationCommand('emap2sec', 'emap2secPlus')}"
+		envActivationCommand = Plugin.getProtocolFullActivationCommand('emap2sec', 'emap2secPlus')
 		
-		moveToRepoCommand = "cd"
-		self.runJob(moveToRepoCommand, Plugin._emap2secplusBinary, cwd=Plugin._emap2secplusBinary)
-
 		runCommand = f"{envActivationCommand} && python3 main.py"
 		self.runJob(runCommand, args[0], cwd=Plugin._emap2secplusBinary)
 
-		self.runJob("mv", f"{args[1][0]} {args[1][1]}", cwd=Plugin._emap2secplusBinary)
-		if len(args[1]) == 4:
-			self.runJob("mv", f"{args[1][2]} {args[1][3]}", cwd=Plugin._emap2secplusBinary)
-
-		if clean:
-			for tmpFile in args[2]:
-				self.runJob("rm -rf", tmpFile, cwd=Plugin._emap2secplusBinary)
+		# Result files are moved and temporary files removed within a single job
+		moveParams = args[1]
+		postCommands = [f"mv {moveParams[idx]} {moveParams[idx + 1]}" for idx in range(0, len(moveParams), 2)]
+		if clean and args[2]:
+			postCommands.append(f"rm -rf {' '.join(args[2])}")
+		self.runJob(' && '.join(postCommands), '', cwd=Plugin._emap2secplusBinary)
 	
 	# --------------------------- INFO functions -----------------------------------
 	def _summary(self):
@@ -165,8 +165,8 @@ class ProtMainMastSegmentMap(EMProtocol):
 		"""
 		This method removes all temporary files to reduce disk usage.
 		"""
-		for tmpFile in tmpFiles:
-			self.runJob("rm -rf", tmpFile, cwd=Mainmast._mainmastBinary)
+		if tmpFiles:
+			self.runJob("rm -rf", ' '.join(tmpFiles), cwd=Mainmast._mainmastBinary)
 
 	# --------------------------- UTILS functions ------------------------------
 	def scapePath(self, path):
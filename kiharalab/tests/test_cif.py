@@ -0,0 +1,91 @@
+import os, tempfile
+
+from pyworkflow.tests import BaseTest
+from pwem.convert.atom_struct import AtomicStructHandler, addScipionAttribute, NAME, RECIP, SPEC, VALUE
+
+from ..utils import writeScipionAttribute
+
+CIF_CONTENT = '''data_test
+#
+loop_
+_atom_site.group_PDB
+_atom_site.id
+_atom_site.type_symbol
+_atom_site.label_atom_id
+_atom_site.label_comp_id
+_atom_site.auth_asym_id
+_atom_site.auth_seq_id
+_atom_site.Cartn_x
+_atom_site.Cartn_y
+_atom_site.Cartn_z
+ATOM 1 N N MET A 1 11.104 6.134 -6.504
+ATOM 2 C CA MET A 1 11.639 6.071 -5.147
+ATOM 3 N N GLY A 2 12.000 7.000 -4.000
+#
+'''
+
+# Values needing quotes, a text field or neither, all of which can also be written through the CIF dictionary
+SCORES = {
+    'A:1': '0.25', 'A:2': '-0.50', 'A:3': "it's", 'A:4': "a' b", 'A:5': 'a" b', 'A:6': 'a\' b" c',
+    'A:7': 'data_x', 'A:8': 'save_1', 'A:9': "'x", 'A:10': "a b'", 'A:11': '_x', 'A:12': '#h', 'A:13': '?'
+}
+
+class TestWriteScipionAttribute(BaseTest):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.inCifFile = os.path.join(self.tmpDir.name, 'input.cif')
+        with open(self.inCifFile, 'w') as f:
+            f.write(CIF_CONTENT)
+        self.handler = AtomicStructHandler()
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def _getPath(self, fileName):
+        return os.path.join(self.tmpDir.name, fileName)
+
+    def _writeReference(self, inCifFile, outCifFile, scores, attrName):
+        """ Writes the attribute through the full CIF dictionary, as done before streaming the file. """
+        cifDic = addScipionAttribute(self.handler.readLowLevel(inCifFile), scores, attrName)
+        self.handler._writeLowLevel(outCifFile, cifDic)
+
+    def _checkSameContents(self, scores, attrName, inCifFile=None):
+        """ Checks that the streamed file and the reference one are read back into the same CIF dictionary. """
+        inCifFile = inCifFile if inCifFile else self.inCifFile
+        streamedFile, referenceFile = self._getPath('streamed.cif'), self._getPath('reference.cif')
+        writeScipionAttribute(inCifFile, streamedFile, scores, attrName)
+        self._writeReference(inCifFile, referenceFile, scores, attrName)
+        streamed, reference = self.handler.readLowLevel(streamedFile), self.handler.readLowLevel(referenceFile)
+        self.assertEqual(dict(streamed), dict(reference))
+        return streamed
+
+    def testSameAsCifDictionary(self):
+        cifDic = self._checkSameContents(SCORES, 'DAQ_score')
+        self.assertEqual(dict(zip(cifDic[SPEC], cifDic[VALUE])), SCORES)
+
+    def testQuotedAttributeName(self):
+        cifDic = self._checkSameContents(SCORES, 'DAQ score')
+        self.assertEqual(set(cifDic[NAME]), {'DAQ score'})
+        self.assertEqual(set(cifDic[RECIP]), {'residues'})
+
+    def testExistingAttributes(self):
+        """ Checks that attributes already in the input file are kept along with the new ones. """
+        previousFile = self._getPath('previous.cif')
+        writeScipionAttribute(self.inCifFile, previousFile, {'A:1': '1.0', 'A:2': '2.0'}, 'previous_score')
+        cifDic = self._checkSameContents(SCORES, 'DAQ_score', inCifFile=previousFile)
+        self.assertEqual(set(cifDic[NAME]), {'previous_score', 'DAQ_score'})
+
+    def testValuesOnlyStreamed(self):
+        """ Checks values the CIF dictionary writer can not write, but the streamed writer can. """
+        scores = {'A:1': '', 'A:2': 'x\ty', 'A:3': 'Data_y', 'A:4': 'line1\nline2'}
+        outCifFile = self._getPath('streamed.cif')
+        writeScipionAttribute(self.inCifFile, outCifFile, scores, 'DAQ_score')
+        cifDic = self.handler.readLowLevel(outCifFile)
+        self.assertEqual(dict(zip(cifDic[SPEC], cifDic[VALUE])), scores)
+
+    def testReservedWords(self):
+        outCifFile = self._getPath('streamed.cif')
+        for value in ['loop_', 'STOP_', 'global_', 'a\n;b']:
+            with self.assertRaises(ValueError):
+                writeScipionAttribute(self.inCifFile, outCifFile, {'A:1': value}, 'DAQ_score')
+            self.assertFalse(os.path.exists(outCifFile))
@@ -0,0 +1,59 @@
+import os, tempfile
+
+from pyworkflow.tests import BaseTest
+
+from ..utils import parseResidueScores
+
+# Atom records with a HETATM, a record without a trailing newline, records cut before the end of the score column,
+# and two residue fields ('  12' and '12  ') that lead to the same specifier once stripped
+PDB_LINES = [
+    'REMARK   1 SCORES STORED IN THE B-FACTOR COLUMN',
+    'ATOM      1  N   MET A   1      11.104   6.134  -6.504  1.00  0.25           N',
+    'ATOM      2  CA  MET A   1      11.639   6.071  -5.147  1.00  0.99           C',
+    'ATOM      3  N   GLY A  12      12.000   7.000  -4.000  1.00 -0.50           N',
+    'ATOM      4  N   GLY A12        12.500   7.500  -4.500  1.00  0.75           N',
+    'HETATM    5  O   HOH B 101      13.000   8.000  -3.000  1.00  1.50',
+    'HETATM    6  O   HOH B 101      13.500   8.500  -3.500  1.00  2.50',
+    'ATOM      7  N   ALA C   5      14.000   9.000  -2.000  1.00  3.',
+    'ATOM      8  N   ALA C   6      15.000  10.000  -1.000',
+    'TER       9      ALA C   6',
+    'ATOM     10  N   SER D   7      16.000  11.000   0.000  1.00  0.10           N'
+]
+
+def parseResidueScoresLoop(pdbFile):
+    """ Per-line parser the vectorized one replaces, used as reference. """
+    scoresDic = {}
+    with open(pdbFile) as f:
+        for line in f:
+            if line.startswith('ATOM') or line.startswith('HETATM'):
+                resId = f'{line[21].strip()}:{line[22:26].strip()}'
+                if resId not in scoresDic:
+                    scoresDic[resId] = line[60:66].strip()
+    return scoresDic
+
+class TestParseResidueScores(BaseTest):
+    def _checkParser(self, content):
+        """ Checks that both parsers return the same scores, in the same order, for the given file content. """
+        with tempfile.TemporaryDirectory() as tmpDir:
+            pdbFile = os.path.join(tmpDir, 'scores.pdb')
+            with open(pdbFile, 'wb') as f:
+                f.write(content.encode())
+            expected = parseResidueScoresLoop(pdbFile)
+            result = parseResidueScores(pdbFile)
+        self.assertEqual(list(result.items()), list(expected.items()))
+        return result
+
+    def testUnixLineEndings(self):
+        result = self._checkParser('\n'.join(PDB_LINES) + '\n')
+        self.assertEqual(result['A:12'], '-0.50')
+        self.assertEqual(result['B:101'], '1.50')
+
+    def testWindowsLineEndings(self):
+        self._checkParser('\r\n'.join(PDB_LINES) + '\r\n')
+
+    def testNoTrailingNewline(self):
+        self._checkParser('\n'.join(PDB_LINES))
+        self._checkParser('\r\n'.join(PDB_LINES))
+
+    def testEmptyFile(self):
+        self.assertEqual(self._checkParser(''), {})
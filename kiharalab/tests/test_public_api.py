@@ -0,0 +1,17 @@
+import inspect
+
+from pyworkflow.tests import BaseTest
+from pwem.protocols import EMProtocol
+
+from .. import protocols
+
+class TestPublicApi(BaseTest):
+    EXPECTED_PROTOCOLS = ['ProtDAQValidation', 'ProtEmap2sec', 'ProtMainMastSegmentMap', 'ProtCryoREAD', 'ProtDMM']
+
+    def testProtocolExports(self):
+        """ Checks that every protocol is exported and can be discovered by Scipion. """
+        self.assertEqual(sorted(protocols.__all__), sorted(self.EXPECTED_PROTOCOLS))
+        discovered = [name for name, _ in inspect.getmembers(protocols, inspect.isclass)]
+        for protocolName in self.EXPECTED_PROTOCOLS:
+            self.assertIn(protocolName, discovered)
+            self.assertTrue(issubclass(getattr(protocols, protocolName), EMProtocol))
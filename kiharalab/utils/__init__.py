@@ -1 +1,4 @@
-from .utils import *
\ No newline at end of file
+from .utils import *
+from .pdb import parseResidueScores
+from .cif import writeScipionAttribute
+from .convert import convertIfChanged
\ No newline at end of file
@@ -0,0 +1,90 @@
+from pwem.convert.atom_struct import AtomicStructHandler, addScipionAttribute, SECTION, NAME, RECIP, SPEC, VALUE
+
+# Characters and prefixes that cannot start an unquoted CIF value
+CIF_RESERVED_STARTS = ('_', '#', '$', "'", '"', '[', ']', ';')
+CIF_RESERVED_PREFIXES = ('data_', 'save_')
+# Reserved CIF words. Some readers, like Biopython's, take them as keywords even if quoted, so they are not accepted as values
+CIF_RESERVED_WORDS = ('loop_', 'global_', 'stop_')
+
+def _endsQuote(value, quote):
+  """
+  ### This function checks if the given quote character would end a quoted CIF value if used to quote the given value.
+
+  #### Params:
+  - value (str): Value to quote.
+  - quote (str): Quote character.
+
+  #### Returns:
+  - (bool): True if the value contains the quote character followed by a blank space.
+  """
+  return any(char == quote and nextChar.isspace() for char, nextChar in zip(value, value[1:]))
+
+def _formatCifValue(value):
+  """
+  ### This function returns the given value ready to be written as a CIF token, quoting it if needed.
+  ### Values that can not be quoted with either quote character are written as a text field.
+
+  #### Params:
+  - value (any): Value to write.
+
+  #### Returns:
+  - (str): CIF token for the value.
+
+  #### Raises:
+  - ValueError: If the value can not be represented in CIF, since it is a reserved word or contains a line starting with ';'.
+  """
+  value = str(value)
+  lowerValue = value.lower()
+  if lowerValue in CIF_RESERVED_WORDS or '\n;' in value or '\r;' in value:
+    raise ValueError(f"Value {value!r} can not be written in a CIF file.")
+  if value and not value.startswith(CIF_RESERVED_STARTS) and not lowerValue.startswith(CIF_RESERVED_PREFIXES) \
+    and not any(char.isspace() for char in value):
+    return value
+  if '\n' not in value and '\r' not in value:
+    if not _endsQuote(value, "'"):
+      return f"'{value}'"
+    if not _endsQuote(value, '"'):
+      return f'"{value}"'
+  return f'\n;{value}\n;\n'
+
+def writeScipionAttribute(inCifFile, outCifFile, attributeScoresDic, attrName, recipient='residues'):
+  """
+  ### This function writes a copy of the given CIF file including a Scipion attribute section with the given scores.
+  ### The input file is streamed line by line and the attribute loop is appended at the end, so the atom records are never loaded in memory.
+  ### If the input file already contains Scipion attributes, both sets are merged through the full CIF dictionary instead.
+
+  #### Params:
+  - inCifFile (str): Path to the input CIF file.
+  - outCifFile (str): Path to the output CIF file.
+  - attributeScoresDic (dict): Dictionary of the form {spec: value}.
+  - attrName (str): Name of the attribute.
+  - recipient (str): Optional. Type of object the specifiers refer to.
+
+  #### Raises:
+  - ValueError: If any of the values can not be written in a CIF file. Nothing is written in that case.
+
+  #### Example:
+  writeScipionAttribute('/path/to/input.cif', '/path/to/output.cif', {'A:1': '0.5'}, 'DAQ_score')
+  """
+  # Rows are formatted before writing anything, so invalid values do not leave an incomplete output file
+  rowStart = f'{_formatCifValue(attrName)} {_formatCifValue(recipient)}'
+  rows = [f'{rowStart} {_formatCifValue(spec)} {_formatCifValue(value)}\n' for spec, value in attributeScoresDic.items()]
+
+  with open(inCifFile) as fIn, open(outCifFile, 'w') as fOut:
+    line = ''
+    for line in fIn:
+      if line.startswith(SECTION):
+        break
+      fOut.write(line)
+    else:
+      if line and not line.endswith('\n'):
+        fOut.write('\n')
+      fOut.write(f'#\nloop_\n{NAME}\n{RECIP}\n{SPEC}\n{VALUE}\n')
+      fOut.writelines(rows)
+      fOut.write('#\n')
+      return
+
+  # Previous attributes need to be kept in the same loop
+  ASH = AtomicStructHandler()
+  cifDic = addScipionAttribute(ASH.readLowLevel(inCifFile), attributeScoresDic, attrName, recipient=recipient)
+  ASH._writeLowLevel(outCifFile, cifDic)
@@ -0,0 +1,45 @@
+import json, os
+
+def _getFileStamp(fileName):
+  """
+  ### This function returns the information used to detect changes in a file.
+
+  #### Params:
+  - fileName (str): Path to the file.
+
+  #### Returns:
+  - (dict): Dictionary with the absolute path, modification time and size of the file.
+  """
+  stat = os.stat(fileName)
+  return {'path': os.path.abspath(fileName), 'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+
+def convertIfChanged(convertFunc, inFile, outFile):
+  """
+  ### This function converts the input file into the output file, unless the output was already generated from the same unchanged input.
+  ### The input file stamp is recorded in a '<outFile>.src.json' file next to the output.
+
+  #### Params:
+  - convertFunc (function): Conversion function receiving input and output file names, and returning the resulting file name.
+  - inFile (str): Path to the input file.
+  - outFile (str): Path to the output file.
+
+  #### Returns:
+  - (str): Path to the resulting file, as returned by the conversion function.
+
+  #### Example:
+  convertIfChanged(toCIF, '/path/to/input.pdb', '/path/to/output.cif')
+  """
+  manifestFile = f'{outFile}.src.json'
+  stamp = _getFileStamp(inFile)
+  if os.path.exists(outFile) and os.path.exists(manifestFile):
+    with open(manifestFile) as f:
+      if json.load(f) == stamp:
+        return outFile
+
+  result = convertFunc(inFile, outFile)
+
+  # Some conversions return the input file when it is already in the requested format, so there is nothing to record
+  if result == outFile and os.path.exists(outFile):
+    with open(manifestFile, 'w') as f:
+      json.dump(stamp, f)
+  return result
@@ -0,0 +1,90 @@
+import numpy as np
+
+# Fixed-width layout of the first columns of a PDB atom record, up to the B-factor field where scores are stored
+ATOM_RECORD_DTYPE = np.dtype([
+  ('record', 'S6'),
+  ('atom', 'S15'),
+  ('chain', 'S1'),
+  ('residue', 'S4'),
+  ('coordinates', 'S34'),
+  ('score', 'S6')
+])
+
+def _readFixedWidthLines(pdbFile, width):
+  """
+  ### This function reads the first columns of every line of a text file as a fixed-width array.
+  ### Lines shorter than the given width are padded with blank spaces.
+
+  #### Params:
+  - pdbFile (str): Path to the file.
+  - width (int): Number of columns to read from each line.
+
+  #### Returns:
+  - (ndarray): Array of uint8 with one row per line and one column per character.
+  """
+  data = np.fromfile(pdbFile, dtype=np.uint8)
+  if not data.size:
+    return np.empty((0, width), dtype=np.uint8)
+
+  # Locate every line, taking into account a possible missing newline at the end of the file
+  ends = np.flatnonzero(data == ord('\n'))
+  if not ends.size or ends[-1] != data.size - 1:
+    ends = np.append(ends, data.size)
+  starts = np.concatenate(([0], ends[:-1] + 1))
+  lengths = ends - starts
+
+  # Copy a fixed-width window starting at each line, blanking whatever belongs to the next lines
+  buffer = np.concatenate((data, np.full(width, ord(' '), dtype=np.uint8)))
+  lines = np.lib.stride_tricks.sliding_window_view(buffer, width)[starts]
+  shortLines = lengths < width
+  if shortLines.any():
+    lines[shortLines] = np.where(np.arange(width) < lengths[shortLines, None], lines[shortLines], ord(' '))
+  return lines
+
+def _getFirstOccurrences(values):
+  """
+  ### This function returns the positions of the first occurrence of each distinct value, in their original order.
+
+  #### Params:
+  - values (ndarray): Array of values.
+
+  #### Returns:
+  - (ndarray): Array with the sorted positions of the first occurrence of each value.
+  """
+  _, firstOccurrences = np.unique(values, return_index=True)
+  firstOccurrences.sort()
+  return firstOccurrences
+
+def parseResidueScores(pdbFile):
+  """
+  ### This function reads the per-residue score that the Kihara lab programs store in the B-factor column of a PDB file.
+  ### Only the first atom of each residue is taken into account.
+  ### Lines are decoded at once with a structured dtype instead of being sliced one by one in Python.
+
+  #### Params:
+  - pdbFile (str): Path to the PDB file.
+
+  #### Returns:
+  - (dict): Dictionary with {spec: value}, where "spec" is a chimera specifier (chainId:residueIdx) and value is the score as a string.
+
+  #### Example:
+  parseResidueScores('/path/to/daq_score_w9.pdb')
+  """
+  lines = _readFixedWidthLines(pdbFile, ATOM_RECORD_DTYPE.itemsize)
+  atoms = lines.view(ATOM_RECORD_DTYPE).ravel()
+
+  # Keep only atom records
+  isAtom = np.char.startswith(atoms['record'], b'ATOM') | (atoms['record'] == b'HETATM')
+  lines, atoms = lines[isAtom], atoms[isAtom]
+
+  # Chain and residue number are contiguous, so both form a single key to find the first atom of each residue
+  chainOffset = ATOM_RECORD_DTYPE.fields['chain'][1]
+  residueKeys = np.ascontiguousarray(lines[:, chainOffset:chainOffset + 5]).view('S5').ravel()
+  atoms = atoms[_getFirstOccurrences(residueKeys)]
+
+  # Build chimera specifiers as chainId:residueIdx.
+  # Different raw fields can lead to the same specifier once stripped, so only the first atom of each specifier is kept
+  specs = np.char.add(np.char.add(np.char.strip(atoms['chain']), b':'), np.char.strip(atoms['residue']))
+  firstSpecs = _getFirstOccurrences(specs)
+  specs, atoms = specs[firstSpecs], atoms[firstSpecs]
+  return dict(zip(specs.astype(str).tolist(), np.char.strip(atoms['score']).astype(str).tolist()))